@@ -1,5 +1,7 @@
 import time
 
+import numpy as np
+
 
 class Aggregator:
     # Aggregate events from ML
@@ -8,43 +10,68 @@ class Aggregator:
         self._state_threshold = state_threshold
         if self._type == 'time_gap':
             self._time_gap = time_gap
-        self.state = []
+        self.reset()
+
+    def _get_index(self, position):
+        return (self._start + position) % self._state_threshold
+
+    def _get_item_type(self, item, field_to_check):
+        if field_to_check:
+            return type(item[field_to_check])
+        return type(item)
+
+    def _count_run(self, field_to_check):
+        # Length and type of the latest same-type run, it's counted once per field
+        # and then updated on every append
+        run = [0, None]
+        for position in range(len(self) - 1, -1, -1):
+            item_type = self._get_item_type(self._items[self._get_index(position)], field_to_check)
+            if run[0] and item_type != run[1]:
+                break
+            run[0] += 1
+            run[1] = item_type
+        self._runs[field_to_check] = run
+        return run
 
     def append(self, item):
+        index = self._get_index(self._size)
         if len(self) == self._state_threshold:
-            self.state.pop(0)
+            self._start = self._get_index(1)
+        else:
+            self._size += 1
+        self._items[index] = item
         if self._type == 'time_gap':
-            item['timestamp'] = time.time()
-        self.state.append(item)
+            self._timestamps[index] = time.time()
 
-    def _frame_counter_check(self, field_to_check, limit):
-        has_distinction = False
-        batch = self.state[-limit:]
-        for index, item in enumerate(batch):
-            if field_to_check:
-                current_item_type = type(item[field_to_check])
-            else:
-                current_item_type = type(item)
-            prev_item_type = None
-            if index:
-                if field_to_check:
-                    prev_item_type = type(batch[index - 1][field_to_check])
-                else:
-                    prev_item_type = type(batch[index - 1])
+        for field_to_check, run in list(self._runs.items()):
+            try:
+                item_type = self._get_item_type(item, field_to_check)
+            except Exception as ex:
+                # Let check count it again and fail the same way as before
+                del self._runs[field_to_check]
+                continue
+            if run[0] and item_type == run[1]:
+                run[0] = min(run[0] + 1, self._size)
             else:
-                prev_item_type = current_item_type
+                run[0] = 1
+                run[1] = item_type
 
-            if current_item_type != prev_item_type:
-                has_distinction = True
+    def _get_last(self, limit):
+        return [
+            self._items[self._get_index(position)]
+            for position in range(len(self) - limit, len(self))
+        ]
 
-        if not has_distinction and len(self) >= limit:
-            return batch
+    def _frame_counter_check(self, field_to_check, limit):
+        run = self._runs.get(field_to_check) or self._count_run(field_to_check)
+        if run[0] >= limit and len(self) >= limit:
+            return self._get_last(limit)
 
     def _time_gap_check(self, field_to_check, limit):
-        batch = self.state[-limit:]
-        batch_len = len(batch)
-        if batch_len and batch_len == limit \
-                and time.time() - batch[0]['timestamp'] <= self._time_gap:
+        if not len(self) or len(self) < limit:
+            return None
+        first_timestamp = self._timestamps[self._get_index(len(self) - limit)]
+        if time.time() - first_timestamp <= self._time_gap:
             return self._frame_counter_check(field_to_check, limit)
 
     def check(self, field_to_check=None, limit=None):
@@ -55,8 +82,154 @@ class Aggregator:
         elif self._type == 'time_gap':
             return self._time_gap_check(field_to_check, limit)
 
+    @property
+    def state(self):
+        return self._get_last(len(self))
+
     def reset(self):
-        self.state = []
+        # Fixed-capacity ring, timestamps are kept aside for time_gap type
+        self._items = [None] * self._state_threshold
+        self._timestamps = [0.0] * self._state_threshold
+        self._start = 0
+        self._size = 0
+        self._runs = {}
+
+    def __len__(self):
+        return self._size
+
+
+class AggregatorBank:
+    """
+    AggregatorBank keeps many aggregators (one per camera, label, etc. key) in columnar numpy arrays
+    and checks all of them in one vectorized pass, semantics are the same as Aggregator has
+    :param field_to_check: item field to compare types of, it has to be known on append
+    :param capacity: initial number of keys, it grows twice when exceeded
+    """
+    def __init__(
+        self, state_threshold, time_gap=None, aggregator_type='frame_counter',
+        field_to_check=None, capacity=64
+    ):
+        self._type = aggregator_type
+        self._state_threshold = state_threshold
+        if self._type == 'time_gap':
+            self._time_gap = time_gap
+        self._field_to_check = field_to_check
+        self._rows = {}
+        self._keys = []
+        self._type_codes = {}
+        self._capacity = 0
+        self._resize(capacity)
+
+    def _resize(self, capacity):
+        shape = (capacity, self._state_threshold)
+        items = np.empty(shape, object)
+        timestamps = np.zeros(shape)
+        columns = [np.zeros(capacity, np.int64) for index in range(4)]
+        if self._capacity:
+            items[:self._capacity] = self._items
+            timestamps[:self._capacity] = self._timestamps
+            old_columns = [self._heads, self._sizes, self._runs, self._run_types]
+            for column, old_column in zip(columns, old_columns):
+                column[:self._capacity] = old_column
+        self._items = items
+        self._timestamps = timestamps
+        # Next write position, number of items, latest same-type run length and its type code
+        self._heads, self._sizes, self._runs, self._run_types = columns
+        self._capacity = capacity
+
+    def _get_row(self, key):
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self._keys)
+            if row == self._capacity:
+                self._resize(self._capacity * 2)
+            self._rows[key] = row
+            self._keys.append(key)
+        return row
+
+    def _get_type_code(self, item):
+        item_type = type(item[self._field_to_check] if self._field_to_check else item)
+        code = self._type_codes.get(item_type)
+        if code is None:
+            code = self._type_codes[item_type] = len(self._type_codes) + 1
+        return code
+
+    def _append_rows(self, rows, codes, items, timestamp):
+        heads = self._heads[rows]
+        self._items[rows, heads] = items
+        if self._type == 'time_gap':
+            self._timestamps[rows, heads] = timestamp
+        sizes = np.minimum(self._sizes[rows] + 1, self._state_threshold)
+        same_type = (self._runs[rows] > 0) & (self._run_types[rows] == codes)
+        self._runs[rows] = np.where(same_type, np.minimum(self._runs[rows] + 1, sizes), 1)
+        self._run_types[rows] = codes
+        self._sizes[rows] = sizes
+        self._heads[rows] = (heads + 1) % self._state_threshold
+
+    def append(self, results):
+        """
+        :param results: (key, item) pairs, e.g. one ML batch
+        """
+        count = len(results)
+        if not count:
+            return
+        rows = np.empty(count, np.int64)
+        codes = np.empty(count, np.int64)
+        items = np.empty(count, object)
+        for index, (key, item) in enumerate(results):
+            rows[index] = self._get_row(key)
+            codes[index] = self._get_type_code(item)
+            items[index] = item
+
+        # The same key can be met several times in a batch, such items are applied
+        # in rounds to keep their order
+        order = np.argsort(rows, kind='stable')
+        sorted_rows = rows[order]
+        positions = np.arange(count)
+        group_starts = np.r_[True, sorted_rows[1:] != sorted_rows[:-1]]
+        group_start_positions = np.maximum.accumulate(np.where(group_starts, positions, 0))
+        rounds = np.empty(count, np.int64)
+        rounds[order] = positions - group_start_positions
+
+        timestamp = time.time()
+        for current_round in range(rounds.max() + 1):
+            mask = rounds == current_round
+            self._append_rows(rows[mask], codes[mask], items[mask], timestamp)
+
+    def _get_last(self, row, limit):
+        positions = (self._heads[row] - limit + np.arange(limit)) % self._state_threshold
+        return list(self._items[row, positions])
+
+    def check(self, limit=None, keys=None):
+        """
+        :param keys: keys to check, all of them by default
+        :return: dict of key to its last items for every key whose condition fired
+        """
+        if not limit:
+            limit = self._state_threshold
+        if keys is None:
+            rows = np.arange(len(self._keys))
+        else:
+            rows = np.array([self._rows[key] for key in keys if key in self._rows], np.int64)
+        fired = (self._runs[rows] >= limit) & (self._sizes[rows] >= limit)
+        if self._type == 'time_gap':
+            first_positions = (self._heads[rows] - limit) % self._state_threshold
+            time_gaps = time.time() - self._timestamps[rows, first_positions]
+            fired &= time_gaps <= self._time_gap
+        return {self._keys[row]: self._get_last(row, limit) for row in rows[fired]}
+
+    def get_state(self, key):
+        row = self._rows.get(key)
+        if row is None:
+            return []
+        return self._get_last(row, self._sizes[row])
+
+    def reset(self, keys=None):
+        rows = list(self._rows.values()) if keys is None else \
+            [self._rows[key] for key in keys if key in self._rows]
+        self._items[rows] = None
+        for column in [self._heads, self._sizes, self._runs, self._run_types]:
+            column[rows] = 0
 
     def __len__(self):
-        return len(self.state)
+        return len(self._keys)
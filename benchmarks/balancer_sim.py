@@ -0,0 +1,173 @@
+"""
+Offline MLQueue balancer simulator, it replays arrival and service time traces against
+a balancer on simulated clock, so balancer policies can be tuned without cameras and GPU
+
+    python -m benchmarks.balancer_sim --balancer step --balancer latency
+    python -m benchmarks.balancer_sim --trace trace.json --output report.json
+
+Trace is JSON with arrival times in seconds and service (batch inference) times:
+
+    {"arrivals": [0.0, 0.04, ...], "service_times": {"1": 0.012, "8": 0.03, "32": 0.09}}
+
+service time of other batch sizes is interpolated linearly. Without trace bursty
+synthetic one is generated
+Report has drop rate, latency percentiles (arrival to end of inference) and GPU batch
+efficiency (GPU throughput relative to the one of max size batches)
+"""
+import argparse
+import json
+import logging
+import math
+import random
+
+import numpy as np
+
+from ml_queue import MLQueue, LatencyBalancer
+
+DEFAULT_CONFIG = {'max_size': 1000, 'max_batch_size': 32}
+DEFAULT_SERVICE_TIMES = {1: 0.01, 8: 0.025, 32: 0.08}
+
+
+def make_bursty_trace(duration=60, base_rate=100, burst_rate=600, burst_every=10,
+                      burst_length=2, seed=0):
+    # Poisson arrivals with periodic bursts, e.g. many cameras waking up at once
+    generator = random.Random(seed)
+    arrivals = []
+    now = 0.0
+    while now < duration:
+        in_burst = now % burst_every < burst_length
+        now += generator.expovariate(burst_rate if in_burst else base_rate)
+        arrivals.append(now)
+    return {'arrivals': arrivals, 'service_times': DEFAULT_SERVICE_TIMES}
+
+
+class ServiceTime:
+    # Batch inference time by batch size, linear interpolation between known sizes
+    def __init__(self, service_times):
+        points = sorted((int(size), float(seconds)) for size, seconds in service_times.items())
+        self._sizes = [size for size, seconds in points]
+        self._seconds = [seconds for size, seconds in points]
+
+    def __call__(self, batch_size):
+        if len(self._sizes) == 1:
+            return self._seconds[0] * batch_size / self._sizes[0]
+        if batch_size > self._sizes[-1]:
+            slope = (self._seconds[-1] - self._seconds[-2]) / (self._sizes[-1] - self._sizes[-2])
+            return self._seconds[-1] + slope * (batch_size - self._sizes[-1])
+        return float(np.interp(batch_size, self._sizes, self._seconds))
+
+
+def simulate(trace, config, balancer=None, consumer='get'):
+    """
+    Discrete-event simulation of producers putting items at trace arrival times and
+    single consumer (GPU) getting batches whenever it's free
+    :param balancer: balancer instance, MLQueue default one if it isn't set
+    :param consumer: 'get' is MLQueue.get() (single item while queue is diluted),
+        'get_batch' is MLQueue.get_batch() of balancer batch size
+    """
+    clock = [0.0]
+    config = dict(config, clock=lambda: clock[0], balancer=balancer)
+    ml_queue = MLQueue('simulation', config)
+    service_time = ServiceTime(trace['service_times'])
+    arrivals = trace['arrivals']
+
+    latencies = []
+    batch_sizes = []
+    busy_time = 0.0
+    gpu_free_time = 0.0
+    index = 0
+    while True:
+        next_arrival = arrivals[index] if index < len(arrivals) else math.inf
+        if len(ml_queue) and gpu_free_time <= next_arrival:
+            clock[0] = max(clock[0], gpu_free_time)
+            if consumer == 'get':
+                batch = ml_queue.get()
+            else:
+                batch = ml_queue.get_batch(ml_queue.get_batch_size() or 1)
+            if not batch:
+                continue
+            duration = service_time(len(batch))
+            gpu_free_time = clock[0] + duration
+            busy_time += duration
+            batch_sizes.append(len(batch))
+            latencies.extend(gpu_free_time - arrival for arrival in batch)
+        elif index < len(arrivals):
+            clock[0] = next_arrival
+            ml_queue.put(next_arrival)
+            index += 1
+        else:
+            break
+
+    consumed = len(latencies)
+    max_batch_size = config['max_batch_size']
+    total_time = max(gpu_free_time, arrivals[-1]) if arrivals else 0
+    return {
+        'items': len(arrivals),
+        'consumed': consumed,
+        'drop_rate': 1 - consumed / len(arrivals) if arrivals else 0.0,
+        'latency_p50': float(np.percentile(latencies, 50)) if latencies else None,
+        'latency_p95': float(np.percentile(latencies, 95)) if latencies else None,
+        'latency_p99': float(np.percentile(latencies, 99)) if latencies else None,
+        'batches': len(batch_sizes),
+        'mean_batch_size': float(np.mean(batch_sizes)) if batch_sizes else 0.0,
+        # Throughput while GPU is busy relative to the one of max size batches
+        'batch_efficiency': (
+            consumed / busy_time * service_time(max_batch_size) / max_batch_size
+            if busy_time else 0.0
+        ),
+        'gpu_utilization': busy_time / total_time if total_time else 0.0,
+    }
+
+
+def make_balancer(name, config, target_latency):
+    if name == 'step':
+        return None
+    if name == 'latency':
+        return LatencyBalancer(config['max_batch_size'], target_latency=target_latency)
+    raise ValueError(f'Unknown balancer {name}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MLQueue balancer simulator')
+    parser.add_argument('--trace', help='JSON trace, bursty synthetic one by default')
+    parser.add_argument(
+        '--balancer', action='append', choices=['step', 'latency'],
+        help='balancer to simulate, it can be repeated (all by default)'
+    )
+    parser.add_argument('--max-size', type=int, default=DEFAULT_CONFIG['max_size'])
+    parser.add_argument('--max-batch-size', type=int, default=DEFAULT_CONFIG['max_batch_size'])
+    parser.add_argument('--overflow', default='clear', choices=['clear', 'drop_oldest'])
+    parser.add_argument('--target-latency', type=float, default=0.5)
+    parser.add_argument('--consumer', default='get', choices=['get', 'get_batch'])
+    parser.add_argument('--output', help='JSON file to write report to')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.trace:
+        with open(args.trace) as file:
+            trace = json.load(file)
+    else:
+        trace = make_bursty_trace()
+    config = {
+        'max_size': args.max_size,
+        'max_batch_size': args.max_batch_size,
+        'overflow': args.overflow,
+    }
+
+    report = {}
+    for name in args.balancer or ['step', 'latency']:
+        balancer = make_balancer(name, config, args.target_latency)
+        report[name] = result = simulate(trace, config, balancer, args.consumer)
+        print(
+            f'{name}: drop rate {result["drop_rate"]:.3f}, '
+            f'latency p50/p95/p99 {result["latency_p50"]:.3f}/{result["latency_p95"]:.3f}/'
+            f'{result["latency_p99"]:.3f} s, batch efficiency {result["batch_efficiency"]:.2f}, '
+            f'GPU utilization {result["gpu_utilization"]:.2f}'
+        )
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
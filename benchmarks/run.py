@@ -0,0 +1,215 @@
+"""
+Benchmarks for Frame, MLQueue, Aggregator and Camera ingestion
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --compare results.json --threshold 0.2
+
+Results are operations (frames, items) per second, the higher the better
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from aggregator import Aggregator
+from frame import Frame, FrameBatch
+from ml_queue import MLQueue
+# Camera is imported as pycvutils package the same way tests do it
+from tests.test_camera import load_package
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURE = os.path.join(ROOT, 'tests/fixtures/chickens.jpg')
+RESOLUTIONS = [(640, 360), (1280, 720), (1920, 1080)]
+# The same configs are used in tests/test_ml_queue.py
+ML_QUEUE_CONFIGS = {
+    'small': {'max_size': 50, 'max_batch_size': 20},
+    'big': {'max_size': 7000, 'max_batch_size': 250},
+}
+AGGREGATOR_WINDOWS = [5, 50, 500, 5000]
+
+
+def _measure(func, count, min_time):
+    # Best rate of several runs, func does count operations per call
+    rates = []
+    started = time.perf_counter()
+    while not rates or time.perf_counter() - started < min_time:
+        start_time = time.perf_counter()
+        func()
+        rates.append(count / (time.perf_counter() - start_time))
+    return max(rates)
+
+
+def bench_frame(min_time):
+    results = {}
+    with open(FIXTURE, 'rb') as file:
+        image = cv2.imdecode(np.frombuffer(file.read(), np.uint8), cv2.IMREAD_COLOR)
+    for width, height in RESOLUTIONS:
+        binary = cv2.imencode('.jpg', cv2.resize(image, (width, height)))[1].tobytes()
+        name = f'frame.{width}x{height}'
+        decoded = Frame(binary)
+        decoded.as_np_array()
+
+        results[f'{name}.decode'] = _measure(lambda: Frame(binary).as_np_array(), 1, min_time)
+        results[f'{name}.gray'] = _measure(
+            lambda: Frame(decoded.as_np_array()).as_np_array(gray=True), 1, min_time
+        )
+        results[f'{name}.encode'] = _measure(lambda: decoded.as_binary(BGR=True), 1, min_time)
+        # Fresh frames every run, otherwise decode cache hides the decoding
+        results[f'{name}.batch_224'] = _measure(
+            lambda: FrameBatch([Frame(binary) for index in range(10)], (224, 224)).as_tensor(),
+            10,
+            min_time
+        )
+    return results
+
+
+def bench_ml_queue(min_time):
+    results = {}
+    # Puts are small enough not to fill the small queue
+    items = [{'test': 'test', 'test_int': 123}] * 10
+    for name, config in ML_QUEUE_CONFIGS.items():
+        def put_get():
+            ml_queue = MLQueue(name, config)
+            for index in range(100):
+                ml_queue.put(items)
+                while len(ml_queue):
+                    ml_queue.get()
+
+        def balance():
+            ml_queue = MLQueue(name, config)
+            for index in range(1000):
+                ml_queue._balance()
+
+        results[f'ml_queue.{name}.put_get'] = _measure(put_get, 100 * len(items), min_time)
+        results[f'ml_queue.{name}.balance'] = _measure(balance, 1000, min_time)
+    return results
+
+
+def bench_aggregator(min_time):
+    results = {}
+    for window in AGGREGATOR_WINDOWS:
+        def append_check():
+            aggregator = Aggregator(window)
+            for index in range(2000):
+                aggregator.append({'label': None if index % 7 else 1})
+                aggregator.check('label')
+
+        results[f'aggregator.{window}.append_check'] = _measure(append_check, 2000, min_time)
+    return results
+
+
+class _FrameCounter:
+    def __init__(self):
+        self.count = 0
+
+    def put(self, frame):
+        self.count += 1
+
+
+def _bench_camera_format(camera_module, duration, format, resolution, fps, image_dir):
+    width, height = resolution
+    camera = camera_module.Camera(f'testsrc=size={width}x{height}:rate={fps}', 'benchmark', 0)
+    counter = _FrameCounter()
+    camera.start(
+        input_options=['-re', '-f', 'lavfi'] if fps < 1000 else ['-f', 'lavfi'],
+        format=format,
+        resolution=resolution,
+        fps=fps,
+        quality=2,
+        image_dir=image_dir,
+        log_level='error',
+        loop_delay=0,
+        restart=False,
+        queue=counter
+    )
+    time.sleep(1)
+    start_count = counter.count
+    time.sleep(duration)
+    frames = counter.count - start_count
+    camera.stop()
+    name = 'jpeg_file' if format == 'image2' else format
+    return {f'camera.{name}.{width}x{height}.fps': frames / duration}
+
+
+def bench_camera(duration, resolution=(1280, 720), fps=1000):
+    # Local synthetic ffmpeg source, no network is used
+    if not shutil.which('ffmpeg'):
+        logging.info('ffmpeg is not found, camera benchmark is skipped')
+        return {}
+    camera_module = load_package()
+    results = {}
+    with tempfile.TemporaryDirectory() as image_dir:
+        for format in ('rawvideo', 'image2', 'mjpeg'):
+            results.update(
+                _bench_camera_format(camera_module, duration, format, resolution, fps, image_dir)
+            )
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Returns names of results which are slower than baseline more than threshold
+    regressions = []
+    for name, value in sorted(results.items()):
+        base_value = baseline.get(name)
+        if base_value and value < base_value * (1 - threshold):
+            regressions.append(name)
+            print(f'REGRESSION {name}: {value:.1f} < {base_value:.1f}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='py-cv-utils benchmarks')
+    parser.add_argument('--output', help='JSON file to write results to')
+    parser.add_argument('--compare', help='baseline JSON file to compare results with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown ratio')
+    parser.add_argument('--min-time', type=float, default=0.5, help='seconds per benchmark')
+    parser.add_argument('--camera-duration', type=float, default=5)
+    parser.add_argument('--only', help='run only frame, ml_queue, aggregator or camera')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('ml-queue').setLevel(logging.WARNING)
+
+    benchmarks = {
+        'frame': lambda: bench_frame(args.min_time),
+        'ml_queue': lambda: bench_ml_queue(args.min_time),
+        'aggregator': lambda: bench_aggregator(args.min_time),
+        'camera': lambda: bench_camera(args.camera_duration),
+    }
+    results = {}
+    for name, benchmark in benchmarks.items():
+        if not args.only or args.only == name:
+            results.update(benchmark())
+    for name, value in sorted(results.items()):
+        print(f'{name}: {value:.1f}/s')
+
+    report = {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
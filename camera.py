@@ -1,3 +1,6 @@
+import asyncio
+import functools
+import inspect
 import subprocess
 from concurrent.futures import ThreadPoolExecutor
 from time import sleep
@@ -5,67 +8,313 @@ import logging
 import os
 import io
 import signal
+import threading
 import time
 import datetime
 
 import numpy as np
 
+from .decode_pool import MJPEGSplitter  # noqa
+from .file_watcher import get_file_watcher  # noqa
 from .frame import Frame  # noqa
 
 logger = logging.getLogger('camera')
 
 
+class _SplitClock:
+    # Split outputs have constant frame rate, so frame n of output has pts n / fps:
+    # frames of all outputs get wallclock time of the first frame plus their pts,
+    # the same moment has the same timestamp in every output
+    def __init__(self, fps):
+        self._fps = list(fps)
+        self._counts = [0] * len(self._fps)
+        self._start = None
+        self._lock = threading.Lock()
+
+    def get_time(self, index):
+        with self._lock:
+            pts = self._counts[index] / self._fps[index]
+            self._counts[index] += 1
+            if self._start is None:
+                self._start = time.time() - pts
+            return self._start + pts
+
+
 class Camera():
+    # Seconds to wait for a new JPEG file before ffmpeg process is checked again
+    FILE_WAIT_TIMEOUT = 1
+
     def __init__(self, address, name, interval):
         self._address = address
         self._name = name
         self._interval = interval
+        self._metrics = None
+        self._lazy_decode = False
+        self._gate = None
+        self._decode_pool = None
+        self._frame_pool = None
+        self._executor = None
+        self._frame_counter = 0
+        self._last_frame_time = None
+        self._file_key = None
+        # The last read frame, with FramePool enqueued frame is owned by queue consumers:
+        # after they release it (e.g. MLQueue on_drop=release_frames) it has no pixels if it was
+        # read from rawvideo pipe, gated frame is owned by camera and released on the next one
         self.frame = None
+        self._gated = False
+
+    def _clear_frame(self):
+        # Gated frame has no other owner, so its pool buffer is returned
+        if self._gated and self.frame is not None:
+            self.frame.release()
+        self.frame = None
+        self._gated = False
+
+    def _publish(self, frame, queue):
+        self._clear_frame()
+        self.frame = frame
+        self._frame_counter += 1
+        self._last_frame_time = time.monotonic()
+        # Gate (e.g. MotionGate) keeps unchanged frames of static scenes out of the queue
+        self._gated = self._gate is not None and not self._gate.check(frame)
+        if self._gated:
+            if self._metrics:
+                self._metrics.inc('camera_frames_gated', camera=self._name)
+            return None
+        return queue.put(frame)
+
+    def get_frame_counter(self):
+        return self._frame_counter
 
-    def _read(self, path, queue):
+    def get_last_frame_time(self):
+        # time.monotonic() of the last frame, None if there were no frames
+        return self._last_frame_time
+
+    def _observe_read(self, start_time, corrupted=False):
+        if self._metrics:
+            read_ms = (time.perf_counter() - start_time) * 1000
+            self._metrics.observe('camera_read_ms', read_ms, camera=self._name)
+            self._metrics.inc('camera_frames_read', camera=self._name)
+            if corrupted:
+                self._metrics.inc('camera_frames_corrupted', camera=self._name)
+
+    def _read(self, path, queue, watcher):
+        # New file is read as soon as ffmpeg has written it, unchanged file isn't read again
+        # (interval is polling interval if inotify isn't available)
+        if not watcher.wait(self.FILE_WAIT_TIMEOUT):
+            return
+        start_time = time.perf_counter()
         try:
             with io.open(path, 'rb') as stream:
+                stat = os.fstat(stream.fileno())
+                file_key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                if file_key == self._file_key:
+                    return
+                self._file_key = file_key
                 image = stream.read()
+                if self._metrics:
+                    # Time between ffmpeg writing the file and reading it
+                    file_delay_ms = (time.time() - stat.st_mtime) * 1000
+                    self._metrics.observe('camera_file_delay_ms', file_delay_ms, camera=self._name)
         except Exception as ex:
             logger.info(f'{self._name} can\'t read image, skipped')
             sleep(self._interval)
             return
-        frame = Frame(image)
-        if not frame.is_corrupted():
-            self.frame = frame
-            queue.put(self.frame)
-        sleep(self._interval)
+        # ffmpeg writes the file right after capture, so its mtime is capture time
+        self._publish_jpeg(image, start_time, queue, stat.st_mtime)
 
-    def _start_camera_loop(self, **kwargs):
-        image_path = os.path.join('/ramdisk/', f'{self._name}.jpg')
+    def _publish_jpeg(self, image, start_time, queue, timestamp=None):
+        if self._decode_pool is not None:
+            # Decoding is done by pool processes, corrupted frames are counted on their return
+            self._observe_read(start_time)
+            self._decode_pool.submit(
+                image, lambda frame: self._publish_decoded(frame, queue), timestamp, self._name
+            )
+            return
+        frame = Frame(image, timestamp=timestamp, pool=self._frame_pool)
+        # Lazy decoding checks JPEG markers only, damaged frames are found by consumers then
+        # (as_np_array returns None)
+        corrupted = frame.is_corrupted(decode=not self._lazy_decode)
+        self._observe_read(start_time, corrupted)
+        if not corrupted:
+            self._publish(frame, queue)
+
+    def _publish_decoded(self, frame, queue):
+        if frame is None:
+            if self._metrics:
+                self._metrics.inc('camera_frames_corrupted', camera=self._name)
+            return
+        self._publish(frame, queue)
+
+    def _read_mjpeg(self, splitter, queue, clock=None):
+        # JPEG frames are cut from ffmpeg pipe, no disk round-trip and no polling
+        start_time = time.perf_counter()
+        image = splitter.read()
+        if image is None:
+            logger.info(f'{self._name} pipe is closed')
+            return False
+        self._publish_jpeg(image, start_time, queue, clock() if clock else time.time())
+        return True
+
+    def _read_pipe(self, stream, shape, queue, clock=None):
+        # Raw frames have a fixed size, so ffmpeg output is read straight into the array
+        # without any disk round-trip or JPEG codec
+        start_time = time.perf_counter()
+        image = self._read_raw(stream, shape)
+        if image is None:
+            return False
+        self._observe_read(start_time)
+        self._publish(self._make_frame(image, self._frame_pool, clock and clock()), queue)
+        return True
+
+    def _read_raw(self, stream, shape):
+        # Fixed size frame of pool buffer if there is FramePool, None if pipe is closed
+        if self._frame_pool is not None:
+            image = self._frame_pool.acquire(shape)
+        else:
+            image = np.empty(shape, np.uint8)
+        buffer = memoryview(image).cast('B')
+        received = 0
+        while received < len(buffer):
+            count = stream.readinto(buffer[received:])
+            if not count:
+                logger.info(f'{self._name} pipe is closed, frame skipped')
+                if self._frame_pool is not None:
+                    self._frame_pool.release(image)
+                return None
+            received += count
+        return image
+
+    def _read_output(self, stream, output, clock):
+        # Reader thread of extra split output, its frames go to output queue as they are
+        # (gate, decode pool and Camera.frame are for the main output only)
+        splitter = MJPEGSplitter(stream) if output['format'] == 'mjpeg' else None
+        try:
+            while True:
+                if splitter:
+                    image = splitter.read()
+                    frame = None if image is None else Frame(image, timestamp=clock())
+                    if frame is not None and frame.is_corrupted():
+                        continue
+                else:
+                    image = self._read_raw(stream, output['shape'])
+                    frame = None if image is None else \
+                        self._make_frame(image, self._frame_pool, clock())
+                if frame is None:
+                    logger.info(f'{self._name} {output["resolution"]} output pipe is closed')
+                    break
+                if self._metrics:
+                    self._metrics.inc(
+                        'camera_output_frames', camera=self._name,
+                        resolution='x'.join(map(str, output['resolution']))
+                    )
+                try:
+                    output['queue'].put(frame)
+                except Exception as ex:
+                    # Closed pipe would fail ffmpeg and all outputs with it
+                    logger.exception(f'{self._name} {output["resolution"]} output put failed')
+        finally:
+            stream.close()
+
+    def _make_frame(self, image, pool=None, timestamp=None):
+        if image.ndim == 2:
+            return Frame(image, single_channel=True, timestamp=timestamp, pool=pool)
+        return Frame(image, BGR=True, timestamp=timestamp, pool=pool)
+
+    @staticmethod
+    def _get_shape(resolution, pix_fmt):
+        width, height = resolution
+        return (height, width) if pix_fmt == 'gray' else (height, width, 3)
+
+    def _get_split_command(self, input_options, **kwargs):
+        # One decode is split to outputs of their resolutions and fps, the main output goes to
+        # stdout and the others to their pipe fds, cfr keeps pts of frame n at n / fps
+        outputs = [dict(kwargs, pipe='pipe:1'), *kwargs['outputs']]
+        for output in outputs:
+            if output.get('format', 'rawvideo') not in ('rawvideo', 'mjpeg'):
+                raise ValueError('Split outputs support rawvideo and mjpeg formats only')
+        labels = ''.join(f'[s{index}]' for index in range(len(outputs)))
+        graph = [f'[0:v]split={len(outputs)}{labels}']
+        for index, output in enumerate(outputs):
+            width, height = output['resolution']
+            graph.append(f'[s{index}]fps=fps={output["fps"]},scale={width}x{height}[o{index}]')
+        command = [
+            'ffmpeg',
+            '-y',
+            *input_options,
+            '-i', self._address,
+            '-loglevel', kwargs['log_level'],
+            '-filter_complex', ';'.join(graph),
+        ]
+        for index, output in enumerate(outputs):
+            # Output options apply to the next output only
+            command += [
+                '-map', f'[o{index}]', '-f', output.get('format', 'rawvideo'), '-threads', '1'
+            ]
+            if output.get('format', 'rawvideo') == 'rawvideo':
+                command += ['-pix_fmt', output.get('pix_fmt', 'bgr24')]
+            else:
+                command += ['-qscale:v', str(output.get('quality', kwargs.get('quality', 2)))]
+            command += ['-vsync', 'cfr', output['pipe']]
+        shape = None
+        if kwargs['format'] == 'rawvideo':
+            shape = self._get_shape(kwargs['resolution'], kwargs.get('pix_fmt', 'bgr24'))
+        return command, shape
+
+    def _get_command(self, image_path, **kwargs):
+        # Returns ffmpeg command and frame shape for rawvideo pipe (None for JPEG file and pipe)
         width = kwargs['resolution'][0]
         height = kwargs['resolution'][1]
         fps = kwargs['fps']
-        self._process = subprocess.Popen([
+        # Input options are RTSP ones by default, e.g. ['-f', 'lavfi'] is for local test source
+        input_options = kwargs.get(
+            'input_options',
+            ['-rtsp_transport', 'tcp', '-stimeout', '5000000']
+        )
+        if kwargs.get('outputs'):
+            return self._get_split_command(input_options, **kwargs)
+        command = [
             'ffmpeg',
             '-y',
-            '-rtsp_transport', 'tcp',
-            '-stimeout', '5000000',
+            *input_options,
             '-i', self._address,
             '-loglevel', kwargs['log_level'],
             '-f', kwargs['format'],
-            '-qscale:v', str(kwargs['quality']),
-            '-s', f'{width}x{height}',
-            '-vf', f'fps=fps={fps}',
-            '-threads', '1',
-            '-vsync', 'vfr',
-            '-updatefirst', '1',
-            image_path
-        ], preexec_fn=os.setsid)
-        sleep(kwargs['loop_delay'])
-        logger.info(f'{self._name} is started to work on {fps} fps')
+        ]
+        shape = None
+        if kwargs['format'] == 'rawvideo':
+            pix_fmt = kwargs.get('pix_fmt', 'bgr24')
+            shape = self._get_shape(kwargs['resolution'], pix_fmt)
+            command += [
+                '-pix_fmt', pix_fmt,
+                '-s', f'{width}x{height}',
+                '-vf', f'fps=fps={fps}',
+                '-threads', '1',
+                '-vsync', 'vfr',
+                'pipe:1'
+            ]
+        elif kwargs['format'] == 'mjpeg':
+            command += [
+                '-qscale:v', str(kwargs['quality']),
+                '-s', f'{width}x{height}',
+                '-vf', f'fps=fps={fps}',
+                '-threads', '1',
+                '-vsync', 'vfr',
+                'pipe:1'
+            ]
+        else:
+            command += [
+                '-qscale:v', str(kwargs['quality']),
+                '-s', f'{width}x{height}',
+                '-vf', f'fps=fps={fps}',
+                '-threads', '1',
+                '-vsync', 'vfr',
+                '-updatefirst', '1',
+                image_path
+            ]
+        return command, shape
 
-        start_time = time.time()
-        while self._process.poll() is None:
-            self._read(image_path, kwargs['queue'])
-
-        # Next code works if process of reading images fails and while loop is interrupted
-        self.frame = None
+    def _log_interrupted(self, start_time):
         interrupted_time = time.time()
         working_time = str(
             datetime.timedelta(
@@ -73,6 +322,82 @@ class Camera():
             )
         )
         logger.info(f'{self._name} loop was interrupted, working time: {working_time}')
+
+    def _start_camera_loop(self, **kwargs):
+        self._metrics = kwargs.get('metrics')
+        self._lazy_decode = kwargs.get('lazy_decode', False)
+        self._gate = kwargs.get('gate')
+        # DecodePool can be shared by many cameras, it's closed by its owner
+        self._decode_pool = kwargs.get('decode_pool')
+        # FramePool buffers are returned by frame consumers (Frame.release())
+        self._frame_pool = kwargs.get('frame_pool')
+        # Every camera has its own directory, so inotify watcher isn't woken up by other cameras
+        image_dir = os.path.join(kwargs.get('image_dir', '/ramdisk/'), self._name)
+        image_path = os.path.join(image_dir, f'{self._name}.jpg')
+        if kwargs['format'] not in ('rawvideo', 'mjpeg'):
+            os.makedirs(image_dir, exist_ok=True)
+        # Extra outputs of the same decode, e.g. small frames for detection and big ones for crops:
+        # [{'resolution': (w, h), 'fps': fps, 'queue': queue, 'format': 'rawvideo'}, ...]
+        outputs = []
+        for output in kwargs.get('outputs') or []:
+            read_fd, write_fd = os.pipe()
+            outputs.append(dict(
+                output, format=output.get('format', 'rawvideo'), pipe=f'pipe:{write_fd}',
+                read_fd=read_fd, write_fd=write_fd,
+                shape=self._get_shape(output['resolution'], output.get('pix_fmt', 'bgr24'))
+            ))
+        try:
+            command, shape = self._get_command(image_path, **dict(kwargs, outputs=outputs))
+        except ValueError:
+            for output in outputs:
+                os.close(output['read_fd'])
+                os.close(output['write_fd'])
+            raise
+        mjpeg = kwargs['format'] == 'mjpeg'
+        # Watching starts before ffmpeg, so the first frame isn't missed
+        watcher = None if shape or mjpeg else get_file_watcher(image_path, self._interval)
+        self._process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE if shape or mjpeg else None,
+            pass_fds=[output['write_fd'] for output in outputs],
+            preexec_fn=os.setsid
+        )
+        clock = None
+        if outputs:
+            split_clock = _SplitClock([kwargs['fps']] + [output['fps'] for output in outputs])
+            clock = functools.partial(split_clock.get_time, 0)
+        for index, output in enumerate(outputs, 1):
+            # Only ffmpeg keeps write ends, so readers see the end of pipes when it exits
+            os.close(output['write_fd'])
+            threading.Thread(
+                target=self._read_output,
+                args=(
+                    io.open(output['read_fd'], 'rb'), output,
+                    functools.partial(split_clock.get_time, index)
+                ),
+                name=f'{self._name}-output-{index}',
+                daemon=True
+            ).start()
+        splitter = MJPEGSplitter(self._process.stdout) if mjpeg else None
+        sleep(kwargs['loop_delay'])
+        logger.info(f'{self._name} is started to work on {kwargs["fps"]} fps')
+
+        start_time = time.time()
+        while self._process.poll() is None:
+            if shape:
+                if not self._read_pipe(self._process.stdout, shape, kwargs['queue'], clock):
+                    break
+            elif splitter:
+                if not self._read_mjpeg(splitter, kwargs['queue'], clock):
+                    break
+            else:
+                self._read(image_path, kwargs['queue'], watcher)
+        if watcher:
+            watcher.close()
+
+        # Next code works if process of reading images fails and while loop is interrupted
+        self._clear_frame()
+        self._log_interrupted(start_time)
         if kwargs['restart']:
             sleep(kwargs['restart_delay'])
             self.restart(**kwargs)
@@ -88,14 +413,98 @@ class Camera():
         except Exception as ex:
             logger.info(f'{self._name} can\'t find and kill camera process')
 
-    def start(self, **kwargs):
-        ThreadPoolExecutor().submit(self._start_camera_loop, **kwargs)
+    def start(self, executor=None, **kwargs):
+        # Camera loop takes a thread of passed executor (e.g. CameraManager's one),
+        # otherwise camera creates its own single thread executor and shuts it down on stop,
+        # so restarts don't leak threads
+        if executor is None:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(1, thread_name_prefix=self._name)
+            executor = self._executor
+        return executor.submit(self._start_camera_loop, **kwargs)
 
     def stop(self):
-        self.frame = None
+        self._clear_frame()
         self._kill_process()
+        if self._executor is not None:
+            # Current loop finishes in the old thread, restart gets the new one
+            self._executor.shutdown(wait=False)
+            self._executor = None
 
     def restart(self, **kwargs):
         logger.info(f'{self._name} camera is going to restart, let\'s pray')
         self.stop()
         self.start(**kwargs)
+
+
+class AsyncCamera(Camera):
+    # Camera for asyncio apps, frames are read from ffmpeg stdout pipe on the event loop
+    # without a thread per camera, only rawvideo format is supported
+    async def _start_camera_loop(self, **kwargs):
+        self._metrics = kwargs.get('metrics')
+        self._gate = kwargs.get('gate')
+        command, shape = self._get_command(None, **kwargs)
+        frame_size = int(np.prod(shape))
+        while True:
+            self._process = await asyncio.create_subprocess_exec(
+                *command,
+                stdout=asyncio.subprocess.PIPE,
+                start_new_session=True
+            )
+            start_time = time.time()
+            try:
+                await asyncio.sleep(kwargs['loop_delay'])
+                logger.info(f'{self._name} is started to work on {kwargs["fps"]} fps')
+                await self._read_pipe_async(frame_size, shape, kwargs['queue'])
+            except asyncio.CancelledError:
+                # stop() cancels the task, the process is reaped before the task is done
+                self._kill_process()
+                await self._process.wait()
+                raise
+
+            self._clear_frame()
+            self._log_interrupted(start_time)
+            if not kwargs['restart']:
+                self._kill_process()
+                await self._process.wait()
+                break
+            await asyncio.sleep(kwargs['restart_delay'])
+            logger.info(f'{self._name} camera is going to restart, let\'s pray')
+            self._kill_process()
+            # Reaps the process, otherwise every restart leaves a zombie
+            await self._process.wait()
+
+    async def _read_pipe_async(self, frame_size, shape, queue):
+        while self._process.returncode is None:
+            read_start_time = time.perf_counter()
+            try:
+                image = await self._process.stdout.readexactly(frame_size)
+            except asyncio.IncompleteReadError as ex:
+                logger.info(f'{self._name} pipe is closed, frame skipped')
+                break
+            self._observe_read(read_start_time)
+            # Bytes are immutable, so pixels are copied to writable array
+            np_image = np.empty(shape, np.uint8)
+            np_image.ravel()[:] = np.frombuffer(image, np.uint8)
+            frame = self._make_frame(np_image)
+            result = self._publish(frame, queue)
+            if inspect.isawaitable(result):
+                await result
+
+    def start(self, **kwargs):
+        if kwargs['format'] != 'rawvideo':
+            raise ValueError('AsyncCamera supports rawvideo format only')
+        if kwargs.get('outputs'):
+            raise ValueError('AsyncCamera doesn\'t support split outputs')
+        self._task = asyncio.ensure_future(self._start_camera_loop(**kwargs))
+        return self._task
+
+    def stop(self):
+        self._clear_frame()
+        self._task.cancel()
+        self._kill_process()
+
+    def restart(self, **kwargs):
+        logger.info(f'{self._name} camera is going to restart, let\'s pray')
+        self.stop()
+        return self.start(**kwargs)
@@ -0,0 +1,158 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger('camera-manager')
+
+
+class CameraManager:
+    """
+    CameraManager runs many cameras on one bounded thread pool, restarts failed and stalled
+    ffmpeg processes with jittered exponential backoff and reports per-camera health and fps
+    :param max_workers: pool size and max number of cameras, every camera loop takes one thread
+    :param stall_timeout: seconds without frames after which camera is restarted
+    :param backoff_base: the first restart delay, it doubles after every next failure
+    :param backoff_max: restart delay limit
+    """
+    def __init__(
+        self, max_workers, stall_timeout=30, check_interval=1, backoff_base=1, backoff_max=60
+    ):
+        self._max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='camera')
+        self._stall_timeout = stall_timeout
+        self._check_interval = check_interval
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._cameras = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._supervisor = None
+
+    def add(self, camera, **kwargs):
+        # kwargs are the same as Camera.start has, restarts are done by manager
+        kwargs['restart'] = False
+        with self._lock:
+            if camera._name not in self._cameras and len(self._cameras) >= self._max_workers:
+                # Extra camera would wait for a free worker forever
+                raise ValueError(f'{camera._name} camera exceeds {self._max_workers} workers')
+            self._cameras[camera._name] = {
+                'camera': camera,
+                'kwargs': kwargs,
+                'future': None,
+                'started_time': None,
+                'next_start_time': time.monotonic(),
+                'failures': 0,
+                'stopping': False,
+                'status': 'waiting',
+                'fps': 0.0,
+                'prev_frame_counter': camera.get_frame_counter(),
+                'prev_check_time': time.monotonic(),
+            }
+
+    def remove(self, name):
+        with self._lock:
+            state = self._cameras.pop(name, None)
+        if state and state['future']:
+            state['camera'].stop()
+
+    def _schedule_restart(self, state, now, status):
+        state['failures'] += 1
+        delay = min(self._backoff_max, self._backoff_base * 2 ** (state['failures'] - 1))
+        # Jitter prevents all cameras from reconnecting at the same moment after network blip
+        delay *= random.uniform(0.5, 1)
+        state['status'] = status
+        state['next_start_time'] = now + delay
+        logger.info(
+            f'{state["camera"]._name} camera is {status}, restart in {delay:.1f}s ' +
+            f'(failure {state["failures"]})'
+        )
+
+    def _check(self, state, now):
+        camera = state['camera']
+        future = state['future']
+        if future is not None and future.done():
+            if not state['stopping']:
+                self._schedule_restart(state, now, 'failed')
+            # The only camera loop is finished, so it's safe to start the next one
+            state['future'] = future = None
+            state['stopping'] = False
+        if future is None:
+            if now >= state['next_start_time']:
+                state['future'] = camera.start(executor=self._executor, **state['kwargs'])
+                state['started_time'] = None
+                state['status'] = 'starting'
+            return
+        if state['stopping']:
+            # Killing can fail, so it's tried again until the loop is finished
+            camera.stop()
+            return
+
+        if not future.running():
+            return  # It waits for a free worker
+        if state['started_time'] is None:
+            state['started_time'] = now
+
+        frame_counter = camera.get_frame_counter()
+        frames = frame_counter - state['prev_frame_counter']
+        state['fps'] = frames / max(now - state['prev_check_time'], 1e-6)
+        state['prev_frame_counter'] = frame_counter
+        state['prev_check_time'] = now
+        if frames:
+            state['failures'] = 0
+            state['status'] = 'running'
+
+        last_frame_time = camera.get_last_frame_time()
+        if last_frame_time is None or last_frame_time < state['started_time']:
+            last_frame_time = state['started_time']
+        if now - last_frame_time > self._stall_timeout:
+            # Killed process interrupts camera loop and frees the worker
+            camera.stop()
+            state['stopping'] = True
+            self._schedule_restart(state, now, 'stalled')
+
+    def _supervise(self):
+        while not self._stopped.wait(self._check_interval):
+            now = time.monotonic()
+            with self._lock:
+                states = list(self._cameras.values())
+            for state in states:
+                try:
+                    self._check(state, now)
+                except Exception as ex:
+                    logger.exception(f'{state["camera"]._name} camera check is failed')
+
+    def start(self):
+        self._stopped.clear()
+        self._supervisor = threading.Thread(target=self._supervise, daemon=True)
+        self._supervisor.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._supervisor:
+            self._supervisor.join()
+        with self._lock:
+            states = list(self._cameras.values())
+        for state in states:
+            if state['future'] and not state['future'].cancel():
+                state['camera'].stop()
+            state['future'] = None
+            state['status'] = 'stopped'
+        self._executor.shutdown(wait=False)
+
+    def get_health(self):
+        # Status, fps, failures in a row and seconds since the last frame per camera name
+        now = time.monotonic()
+        health = {}
+        with self._lock:
+            states = list(self._cameras.items())
+        for name, state in states:
+            last_frame_time = state['camera'].get_last_frame_time()
+            health[name] = {
+                'status': state['status'],
+                'fps': state['fps'],
+                'failures': state['failures'],
+                'last_frame_age': None if last_frame_time is None else now - last_frame_time,
+            }
+        return health
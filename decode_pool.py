@@ -0,0 +1,122 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import multiprocessing
+import os
+import threading
+
+from .frame import Frame  # noqa
+
+logger = logging.getLogger('decode-pool')
+
+JPEG_EOI = b'\xff\xd9'
+
+
+def _decode(image, BGR, size):
+    # Runs in worker process, pixels are sent back pickled (resizing there makes them cheaper)
+    return Frame(image).as_np_array(BGR=BGR, size=size)
+
+
+class MJPEGSplitter:
+    """
+    MJPEGSplitter cuts ffmpeg mjpeg pipe output into separate JPEG bins without decoding,
+    EOI marker can't appear inside entropy-coded data as 0xff bytes are stuffed there
+    :param stream: binary stream, e.g. ffmpeg process stdout
+    :param chunk_size: bytes to read at once
+    """
+    def __init__(self, stream, chunk_size=64 * 1024):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def read(self):
+        # The next JPEG bin, None if stream is closed
+        while True:
+            end = self._buffer.find(JPEG_EOI, self._offset)
+            if end >= 0:
+                image = bytes(self._buffer[:end + len(JPEG_EOI)])
+                del self._buffer[:end + len(JPEG_EOI)]
+                self._offset = 0
+                return image
+            # EOI can be split between chunks
+            self._offset = max(len(self._buffer) - 1, 0)
+            read = getattr(self._stream, 'read1', self._stream.read)
+            chunk = read(self._chunk_size)
+            if not chunk:
+                return None
+            self._buffer += chunk
+
+
+class DecodePool:
+    """
+    DecodePool decodes (and optionally resizes) JPEG frames of many cameras in worker processes,
+    so decoding isn't limited by GIL of one process. Frames are given to callback with their
+    capture timestamps, callback is called in pool thread, frames of different workers can come
+    out of order
+    :param workers: number of processes, CPU count by default
+    :param size: (width, height) to resize to, JPEG is decoded at reduced scale if it's possible
+    :param BGR: channel order of decoded pixels
+    :param max_pending: frames in flight, new frames are dropped above it, workers * 4 by default
+    :param metrics: Metrics instance
+    :param mp_context: multiprocessing context of workers, forkserver by default as forking
+        of process with running camera threads can copy their held locks
+    """
+    def __init__(
+        self, workers=None, size=None, BGR=True, max_pending=None, metrics=None, mp_context=None
+    ):
+        self._workers = workers or os.cpu_count() or 1
+        self._size = tuple(size) if size else None
+        self._BGR = BGR
+        self._max_pending = max_pending or self._workers * 4
+        self._metrics = metrics
+        self._pending = 0
+        self._lock = threading.Lock()
+        if mp_context is None:
+            methods = multiprocessing.get_all_start_methods()
+            mp_context = multiprocessing.get_context(
+                'forkserver' if 'forkserver' in methods else 'spawn'
+            )
+        self._executor = ProcessPoolExecutor(self._workers, mp_context=mp_context)
+
+    def submit(self, image, callback, timestamp=None, source=None):
+        """
+        :param image: JPEG bin
+        :param callback: callback(frame), frame is None if JPEG is corrupted
+        :param timestamp: capture time, it's kept by decoded frame
+        :param source: label of metrics and logs, e.g. camera name
+        :return: False if frame is dropped as pool is overloaded
+        """
+        with self._lock:
+            if self._pending >= self._max_pending:
+                if self._metrics:
+                    self._metrics.inc('decode_pool_dropped', source=source)
+                return False
+            self._pending += 1
+        future = self._executor.submit(_decode, image, self._BGR, self._size)
+        future.add_done_callback(lambda future: self._done(future, callback, timestamp, source))
+        return True
+
+    def _done(self, future, callback, timestamp, source):
+        with self._lock:
+            self._pending -= 1
+        try:
+            np_image = future.result()
+        except Exception as ex:
+            logger.info(f'{source} frame can\'t be decoded: {ex}')
+            np_image = None
+        frame = None
+        if np_image is not None:
+            if np_image.ndim == 2:
+                frame = Frame(np_image, single_channel=True, timestamp=timestamp)
+            else:
+                frame = Frame(np_image, BGR=self._BGR, timestamp=timestamp)
+        try:
+            callback(frame)
+        except Exception as ex:
+            logger.exception(f'{source} decoded frame callback failed')
+
+    def get_pending(self):
+        return self._pending
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
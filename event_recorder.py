@@ -0,0 +1,216 @@
+import collections
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+
+import cv2
+
+logger = logging.getLogger('event-recorder')
+
+JPEG_SOI = b'\xff\xd8'
+
+
+class _Clip:
+    # Clip writer thread feeds JPEG frames to its ffmpeg stdin at constant frame rate:
+    # every tick gets the latest frame captured before it, so capture timestamps are kept
+    # (frames are repeated or skipped) and JPEG bins are muxed as they are
+    def __init__(self, process, path, end_time, fps, timeout, metrics=None, name=None):
+        self.path = path
+        self.end_time = end_time
+        self._process = process
+        self._interval = 1 / fps
+        self._timeout = timeout
+        self._metrics = metrics
+        self._name = name
+        self._queue = queue.Queue()
+        self._tick = None
+        self._last = None
+        self.written = 0
+        self.thread = threading.Thread(target=self._run, name=f'{name}-clip', daemon=True)
+        self.thread.start()
+
+    def feed(self, timestamp, data):
+        self._queue.put((timestamp, data))
+
+    def finish(self):
+        self._queue.put(None)
+
+    def _write(self, data, until):
+        while self._tick < until:
+            self._process.stdin.write(data)
+            self._tick += self._interval
+            self.written += 1
+
+    def _run(self):
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=self._timeout)
+                except queue.Empty:
+                    logger.info(f'{self._name} has no frames for {self.path}, clip is finished')
+                    break
+                if item is None:
+                    break
+                timestamp, data = item
+                if self._last is None:
+                    self._tick = timestamp
+                elif timestamp > self._last[0]:
+                    self._write(self._last[1], timestamp)
+                self._last = (timestamp, data)
+            if self._last is not None:
+                # The last frame lasts one interval at least
+                self._write(self._last[1], max(self._tick, self._last[0]) + self._interval / 2)
+            self._process.stdin.close()
+        except (BrokenPipeError, ValueError) as ex:
+            logger.info(f'{self._name} ffmpeg pipe of {self.path} is closed: {ex}')
+        code = self._process.wait()
+        if code:
+            logger.info(f'{self._name} ffmpeg failed to write {self.path}, exit code {code}')
+        if self._metrics:
+            self._metrics.inc('recorder_clips', recorder=self._name)
+            if code:
+                self._metrics.inc('recorder_clips_failed', recorder=self._name)
+            self._metrics.inc('recorder_frames_written', self.written, recorder=self._name)
+
+
+class EventRecorder:
+    """
+    EventRecorder keeps the last pre_seconds of JPEG frames in memory ring and writes
+    pre/post-event clips on trigger, e.g. when Aggregator.check() fires. Clip is streamed to one
+    ffmpeg process through its stdin, JPEG bins are copied to the container without re-encoding,
+    so camera JPEG frames are neither decoded nor encoded (numpy frames are encoded once)
+    It has queue put() interface, so it can be Camera queue or be fed by frame consumer
+
+        recorder = EventRecorder(pre_seconds=5, post_seconds=10)
+        ...
+        recorder.put(frame)
+        if aggregator.check('label'):
+            recorder.trigger(f'/records/{camera}-{int(time.time())}.mp4')
+
+    :param pre_seconds: seconds of frames before trigger in clip
+    :param post_seconds: seconds of frames after trigger, trigger during clip extends it
+    :param fps: clip frame rate, frames are repeated or skipped to keep their timestamps
+    :param max_bytes: ring memory budget, the oldest frames are dropped above it
+    :param log_level: ffmpeg log level
+    :param metrics: Metrics instance
+    :param name: label of metrics and logs, e.g. camera name
+    """
+    def __init__(
+        self, pre_seconds=5, post_seconds=5, fps=10, max_bytes=64 * 1024 * 1024,
+        log_level='error', metrics=None, name='recorder'
+    ):
+        self._pre_seconds = pre_seconds
+        self._post_seconds = post_seconds
+        self._fps = fps
+        self._max_bytes = max_bytes
+        self._log_level = log_level
+        self._metrics = metrics
+        self._name = name
+        # (timestamp, JPEG bin), the newest are on the right
+        self._ring = collections.deque()
+        self._nbytes = 0
+        self._clip = None
+        self._lock = threading.Lock()
+
+    def _get_command(self, path):
+        # MJPEG stream is muxed with stream copy, container is chosen by path extension
+        return [
+            'ffmpeg',
+            '-y',
+            '-loglevel', self._log_level,
+            '-f', 'mjpeg',
+            '-framerate', str(self._fps),
+            '-i', 'pipe:0',
+            '-c:v', 'copy',
+            path
+        ]
+
+    @staticmethod
+    def _get_jpeg(frame):
+        # Camera JPEG frames give their original bin until their pixels are exposed
+        data = frame.as_binary()
+        if data[:2] != JPEG_SOI:
+            # E.g. PNG bin, it isn't expected from cameras
+            np_image = frame.as_np_array(BGR=True)
+            data = None if np_image is None else cv2.imencode('.jpg', np_image)[1].tobytes()
+        return data
+
+    def put(self, frame, block=True, timeout=None):
+        if frame.is_corrupted():
+            return
+        data = self._get_jpeg(frame)
+        if data is None:
+            logger.info(f'{self._name} frame isn\'t JPEG, it\'s skipped')
+            return
+        timestamp = frame.get_time()
+        with self._lock:
+            self._ring.append((timestamp, data))
+            self._nbytes += len(data)
+            while self._ring and (
+                self._ring[0][0] < timestamp - self._pre_seconds or
+                self._max_bytes is not None and self._nbytes > self._max_bytes
+            ):
+                self._nbytes -= len(self._ring.popleft()[1])
+            clip = self._clip
+            if clip is None:
+                return
+            if not clip.thread.is_alive():
+                # Clip is finished by timeout (no frames) or ffmpeg failure
+                self._clip = None
+            elif timestamp > clip.end_time:
+                self._clip = None
+                clip.finish()
+            else:
+                clip.feed(timestamp, data)
+
+    def trigger(self, path, event_time=None):
+        """
+        Starts clip of ring frames since event_time - pre_seconds and frames
+        till event_time + post_seconds, trigger during clip extends it instead
+        :param path: clip path, e.g. .mp4, .mkv or .avi
+        :param event_time: event timestamp (time.time() clock as frame timestamps), now by default
+        :return: True if new clip is started, False if current one is extended
+        """
+        if event_time is None:
+            event_time = time.time()
+        with self._lock:
+            end_time = event_time + self._post_seconds
+            if self._clip is not None and self._clip.thread.is_alive():
+                self._clip.end_time = max(self._clip.end_time, end_time)
+                return False
+            process = subprocess.Popen(
+                self._get_command(path), stdin=subprocess.PIPE, preexec_fn=os.setsid
+            )
+            self._clip = _Clip(
+                process, path, end_time, self._fps, self._post_seconds + self._pre_seconds + 1,
+                self._metrics, self._name
+            )
+            start_time = event_time - self._pre_seconds
+            for timestamp, data in self._ring:
+                if timestamp >= start_time:
+                    self._clip.feed(timestamp, data)
+        logger.info(f'{self._name} is recording {path}')
+        return True
+
+    def is_recording(self):
+        clip = self._clip
+        return clip is not None and clip.thread.is_alive()
+
+    def get_nbytes(self):
+        return self._nbytes
+
+    def close(self, wait=True):
+        # Current clip is finished with frames it has got
+        with self._lock:
+            clip = self._clip
+            self._clip = None
+        if clip is not None:
+            clip.finish()
+            if wait:
+                clip.thread.join()
+
+    def __len__(self):
+        return len(self._ring)
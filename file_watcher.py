@@ -0,0 +1,108 @@
+import ctypes
+import logging
+import os
+import select
+import struct
+import time
+
+logger = logging.getLogger('file-watcher')
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+# struct inotify_event header, file name of len bytes follows it
+_EVENT = struct.Struct('iIII')
+
+
+class PollingWatcher:
+    """
+    PollingWatcher checks file inode, size and mtime every interval, it's fallback
+    for systems without inotify
+    :param path: watched file
+    :param interval: seconds between checks
+    """
+    def __init__(self, path, interval):
+        self._path = path
+        self._interval = max(interval, 0.001)
+        # File existing before watching isn't a new one
+        self._key = self._stat()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self._path)
+        except OSError as ex:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def wait(self, timeout):
+        # True if file is changed, False if it isn't for timeout seconds
+        deadline = time.monotonic() + timeout
+        while True:
+            key = self._stat()
+            if key is not None and key != self._key:
+                self._key = key
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self._interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    InotifyWatcher is woken up by the kernel as soon as writer closes the file
+    (or renames a new one to it), so nothing is polled. The whole directory is watched,
+    so writes of other files there wake it up too, the file should have its own directory
+    :param path: watched file, its directory has to exist
+    """
+    def __init__(self, path):
+        directory, name = os.path.split(os.path.abspath(path))
+        self._name = os.fsencode(name)
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(
+            self._fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO
+        ) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, f'inotify_add_watch failed for {directory}')
+
+    def _read_events(self):
+        # True if any of events is about the watched file
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError as ex:
+            return False
+        changed = False
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            length = _EVENT.unpack_from(data, offset)[3]
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+            changed = changed or name == self._name
+            offset += _EVENT.size + length
+        return changed
+
+    def wait(self, timeout):
+        # True if file is changed, False if it isn't for timeout seconds
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = max(deadline - time.monotonic(), 0)
+            if not select.select([self._fd], [], [], remaining)[0]:
+                return False
+            if self._read_events():
+                return True
+
+    def close(self):
+        os.close(self._fd)
+
+
+def get_file_watcher(path, interval):
+    # inotify if it's available, polling otherwise
+    try:
+        return InotifyWatcher(path)
+    except (OSError, AttributeError) as ex:
+        logger.info(f'inotify is not available for {path}, polling is used: {ex}')
+        return PollingWatcher(path, interval)
@@ -1,62 +1,606 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import pickle
+import struct
+import threading
 import cv2
 import numpy as np
 import time
 import datetime
 
+try:
+    import turbojpeg
+except ImportError:
+    turbojpeg = None
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+# Serialized frame header: timestamp, flags (bin channel order is BGR)
+_SERIALIZED_HEADER = struct.Struct('<dB')
+
+_executor = None
+
+
+def _get_executor():
+    # Shared pool for batch preprocessing, cv2 releases GIL so it really works in parallel
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(os.cpu_count())
+    return _executor
+
+
+def get_jpeg_size(image):
+    # (width, height) from JPEG SOF header without decoding, None if it isn't found
+    index = 2
+    while index + 9 <= len(image):
+        if image[index] != 0xFF:
+            return None
+        marker = image[index + 1]
+        if marker == 0xFF:  # Fill byte
+            index += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(image[index + 5:index + 7], 'big')
+            width = int.from_bytes(image[index + 7:index + 9], 'big')
+            return width, height
+        index += 2 + int.from_bytes(image[index + 2:index + 4], 'big')
+    return None
+
+
+class OpenCVDecoder:
+    # Reduced decoding uses JPEG DCT scaling, so the most of pixels aren't decoded at all
+    scales = (1, 2, 4, 8)
+    _flags = {
+        (1, False): cv2.IMREAD_COLOR,
+        (2, False): cv2.IMREAD_REDUCED_COLOR_2,
+        (4, False): cv2.IMREAD_REDUCED_COLOR_4,
+        (8, False): cv2.IMREAD_REDUCED_COLOR_8,
+        (1, True): cv2.IMREAD_GRAYSCALE,
+        (2, True): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+        (4, True): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+        (8, True): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    }
+
+    def decode(self, image, scale=1, gray=False):
+        # BGR or single channel image, None if it can't be decoded
+        return cv2.imdecode(np.frombuffer(image, np.uint8), self._flags[(scale, gray)])
+
+
+class TurboJPEGDecoder:
+    # libjpeg-turbo through optional PyTurboJPEG package, JPEG only
+    scales = (1, 2, 4, 8)
+    # Full size colour image can be decoded into FramePool buffer
+    supports_out = True
+
+    def __init__(self):
+        self._turbojpeg = turbojpeg.TurboJPEG()
+
+    def decode(self, image, scale=1, gray=False, out=None):
+        kwargs = {} if out is None else {'dst': out}
+        np_image = self._turbojpeg.decode(
+            image,
+            pixel_format=turbojpeg.TJPF_GRAY if gray else turbojpeg.TJPF_BGR,
+            scaling_factor=(1, scale) if scale > 1 else None,
+            **kwargs
+        )
+        return np_image[:, :, 0] if gray else np_image
+
+
+def get_default_decoder():
+    if turbojpeg:
+        try:
+            return TurboJPEGDecoder()
+        except Exception as ex:
+            # Package is installed without libjpeg-turbo
+            pass
+    return OpenCVDecoder()
+
+
+def _get_decode_scale(decoder, jpeg_size, size):
+    # The biggest scale whose decoded image is still not smaller than size
+    width, height = jpeg_size
+    target_width, target_height = size
+    for scale in sorted(decoder.scales, reverse=True):
+        if -(-width // scale) >= target_width and -(-height // scale) >= target_height:
+            return scale
+    return 1
+
+
+class FramePool:
+    """
+    FramePool keeps free pixel buffers by shape, so frames of long-running cameras reuse
+    the same memory instead of allocating megabytes per frame. Buffers come back on
+    Frame.release() (e.g. by consumer after inference or by MLQueue on_drop=release_frames),
+    frames which aren't released are just garbage collected
+    :param max_buffers: free buffers kept per shape, extra released ones are garbage collected
+    :param metrics: Metrics instance for frame_pool_hits/misses counters
+    """
+    def __init__(self, max_buffers=64, metrics=None):
+        self._max_buffers = max_buffers
+        self._metrics = metrics
+        self._free = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'released': 0, 'discarded': 0}
+
+    def acquire(self, shape, dtype=np.uint8):
+        key = (tuple(shape), np.dtype(dtype))
+        with self._lock:
+            buffers = self._free.get(key)
+            hit = bool(buffers)
+            buffer = buffers.pop() if hit else None
+            self._stats['hits' if hit else 'misses'] += 1
+        if self._metrics:
+            self._metrics.inc('frame_pool_hits' if hit else 'frame_pool_misses')
+        return buffer if hit else np.empty(shape, dtype)
+
+    def release(self, buffer):
+        # Buffer and its views mustn't be used by caller after it
+        key = (buffer.shape, buffer.dtype)
+        with self._lock:
+            buffers = self._free.setdefault(key, [])
+            if len(buffers) < self._max_buffers:
+                buffers.append(buffer)
+                self._stats['released'] += 1
+            else:
+                self._stats['discarded'] += 1
+
+    def get_stats(self):
+        # Counters, free buffers and their bytes
+        with self._lock:
+            buffers = [buffer for buffers in self._free.values() for buffer in buffers]
+            return dict(
+                self._stats, free=len(buffers), free_bytes=sum(buffer.nbytes for buffer in buffers)
+            )
+
+
+def release_frames(items):
+    # MLQueue on_drop callback, pool buffers of dropped frames are reused
+    for item in items:
+        if isinstance(item, Frame):
+            item.release()
+
 
 class Frame:
     """
     Frame is class for convenient work with bin/numpy images in RGB/BGR format and convertion either
+    Bin images are kept encoded and decoded only on first pixel access, as_binary returns
+    the original bin until full size pixels are given out (they can be changed then)
+    Pixels are stored once in one channel order (BGR for decoded JPEG), the other order is
+    converted on demand into contiguous array (it's cached) or into caller's out buffer.
+    Full size pixels given out by as_np_array become the stored ones in their order, so caller's
+    pixel changes are frame ones until pixels of the other order are given out
     :param image: bin or numpyarray image
+    :param timestamp: capture time, now by default
+    :param pool: FramePool which numpy image is acquired from or bin is decoded into
+        (if decoder supports it), release() returns the buffer
     """
-    def __init__(self, image, BGR=False, single_channel=False):
-        self._timestamp = time.time()
+    # Frames are kept by thousands in ML queues, so they have no per-instance __dict__
+    __slots__ = (
+        '_timestamp', '_pool', '_pooled', '_binary', '_binary_BGR', '_exposed', '_cache',
+        '_image', '_image_BGR', '_other', '_corrupted', '__weakref__'
+    )
+    # Metrics instance to observe decoding time, it's turned off by default
+    metrics = None
+    # JPEG decoder, get_default_decoder() is used if it isn't set
+    decoder = None
+    _opencv_decoder = OpenCVDecoder()
+
+    def __init__(self, image, BGR=False, single_channel=False, timestamp=None, pool=None):
+        self._timestamp = time.time() if timestamp is None else timestamp
+        self._pool = pool
+        self._binary = None
+        self._binary_BGR = BGR
+        self._exposed = False
+        self._cache = {}
+        # The other channel order of full size pixels
+        self._other = None
         if isinstance(image, bytes):
-            try:
-                self._np_image, self._np_image_bgr = self._image_to_np_array(image, BGR)
-                self._corrupted = False
-            except Exception as err:
-                self._corrupted = True
+            self._binary = image
+            self._image = None
+            self._pooled = False
+            # Decoders give BGR, so bin of swapped channels is decoded to RGB
+            self._image_BGR = not BGR
+            # None means unknown until decoding, markers check is cheap but weak:
+            # JPEG with damaged body passes it and turns out to be corrupted on decoding
+            self._corrupted = self._check_jpeg_markers(image)
         else:
-            if BGR:
-                self._np_image = image[:, :, ::-1]
-                self._np_image_bgr = image
-            else:
-                if single_channel:
-                    self._np_image_bgr = image
-                else:
-                    self._np_image_bgr = image[:, :, ::-1]
-                self._np_image = image
+            self._image = image
+            self._pooled = pool is not None
+            self._image_BGR = BGR and not single_channel
             self._corrupted = False
 
+    @staticmethod
+    def _check_jpeg_markers(image):
+        # False if JPEG has SOI and EOI (some cameras pad files after it), otherwise None
+        if image[:2] == JPEG_SOI and image.rfind(JPEG_EOI, max(len(image) - 1024, 2)) != -1:
+            return False
+        return None
+
+    @staticmethod
+    def _get_decoder(image):
+        if image[:2] != JPEG_SOI:
+            return Frame._opencv_decoder
+        if Frame.decoder is None:
+            Frame.decoder = get_default_decoder()
+        return Frame.decoder
+
+    def _decode_to_pool(self, decoder, image):
+        out = None
+        if self._pool is not None and getattr(decoder, 'supports_out', False):
+            jpeg_size = get_jpeg_size(image)
+            if jpeg_size:
+                out = self._pool.acquire((jpeg_size[1], jpeg_size[0], 3))
+        if out is None:
+            return decoder.decode(image)
+        try:
+            np_image = decoder.decode(image, out=out)
+        except Exception as ex:
+            self._pool.release(out)
+            raise
+        if np_image is out:
+            self._pooled = True
+        else:
+            self._pool.release(out)
+        return np_image
+
     def _image_to_np_array(self, image, BGR=False):
-        img_rgb = img_bgr = None
-        if BGR:
-            img_rgb = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
-            img_bgr = img_rgb[:, :, ::-1]
+        # Decoded pixels, they are RGB for BGR bin and BGR otherwise
+        np_image = self._decode_to_pool(self._get_decoder(image), image)
+        if np_image is None:
+            raise ValueError('Image can\'t be decoded')
+        return np_image
+
+    def _decode_reduced(self, BGR, gray, size):
+        # Gray and resized variants of JPEG are decoded directly in grayscale and/or
+        # at reduced size, None means it's not possible or makes no sense
+        # It depends on the bin only, not on whether full pixels are decoded already,
+        # so the same variant is the same regardless of call order
+        if self._binary is None or self._corrupted or self._binary[:2] != JPEG_SOI:
+            return None
+        decoder = self._get_decoder(self._binary)
+        scale = 1
+        if size:
+            jpeg_size = get_jpeg_size(self._binary)
+            if jpeg_size:
+                scale = _get_decode_scale(decoder, jpeg_size, size)
+        # JPEG luma of swapped channels isn't gray, such bin is decoded in colour
+        gray_decode = gray and not self._binary_BGR
+        if scale == 1 and not gray_decode:
+            return None
+        try:
+            np_image = decoder.decode(self._binary, scale, gray_decode)
+        except Exception as err:
+            return None
+        if np_image is None or np_image.ndim == 2:
+            return np_image
+        # Decoded colour order is RGB for BGR bin and BGR otherwise
+        if gray:
+            return cv2.cvtColor(
+                np_image, cv2.COLOR_RGB2GRAY if self._binary_BGR else cv2.COLOR_BGR2GRAY
+            )
+        if BGR == self._binary_BGR:
+            np_image = cv2.cvtColor(np_image, cv2.COLOR_BGR2RGB)
+        return np_image
+
+    def _decode(self):
+        if self._binary is None or self._image is not None or self._corrupted:
+            return
+        start_time = time.perf_counter() if Frame.metrics else None
+        try:
+            self._image = self._image_to_np_array(self._binary, self._binary_BGR)
+            self._corrupted = False
+        except Exception as err:
+            self._corrupted = True
+        if start_time is not None:
+            Frame.metrics.observe('frame_decode_ms', (time.perf_counter() - start_time) * 1000)
+            if self._corrupted:
+                Frame.metrics.inc('frames_corrupted_on_decode')
+
+    def _get_order(self, BGR, out=None):
+        # Full size pixels in channel order, the other one is converted once and cached
+        # unless it's written to out
+        self._decode()
+        image = self._image
+        if image is None or image.ndim == 2 or BGR == self._image_BGR:
+            if out is not None and image is not None:
+                np.copyto(out, image)
+                return out
+            return image
+        if out is not None:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=out)
+        if self._other is None:
+            self._other = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        return self._other
+
+    @property
+    def _np_image(self):
+        return self._get_order(False)
+
+    @property
+    def _np_image_bgr(self):
+        return self._get_order(True)
+
+    def _set_order(self, BGR):
+        # Stored pixels are turned to channel order, they're swapped in place unless
+        # they could be given out or cached before
+        image = self._image
+        if image is None or image.ndim == 2 or BGR == self._image_BGR:
+            return
+        if self._exposed or any(np.may_share_memory(image, item) for item in self._cache.values()):
+            if self._other is not None:
+                image = self._other
+            else:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            # Caller can keep the previous array, so pool buffer isn't returned to the pool
+            self._pooled = False
         else:
-            img_bgr = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
-            img_rgb = img_bgr[:, :, ::-1]
-        return img_rgb, img_bgr
+            cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+        self._image = image
+        self._image_BGR = BGR
+        self._other = None
+
+    def _get_native(self):
+        # Stored array and whether it's BGR
+        self._decode()
+        return self._image, self._image_BGR or self._image is None or self._image.ndim == 2
+
+    @property
+    def nbytes(self):
+        # Memory footprint now: bin, pixels, the other channel order and cached variants
+        nbytes = len(self._binary) if self._binary is not None else 0
+        for np_image in (self._image, self._other):
+            if np_image is not None:
+                nbytes += np_image.nbytes
+        return nbytes + sum(np_image.nbytes for np_image in self._cache.values())
 
     def get_time(self, iso=False):
         if iso:
             return datetime.datetime.utcfromtimestamp(self._timestamp).isoformat() + 'Z'
         return self._timestamp
 
-    def is_corrupted(self):
+    def is_corrupted(self, decode=False):
+        """
+        Without decode it's JPEG markers check for not decoded frames, damaged JPEG body
+        is found on decoding only
+        :param decode: decode frame to be sure
+        """
+        if self._corrupted is None or decode:
+            self._decode()
         return self._corrupted
 
-    def as_np_array(self, BGR=False, gray=False):
-        np_image = self._np_image_bgr if BGR else self._np_image
-        if gray:
-            return cv2.cvtColor(np_image, cv2.COLOR_RGB2GRAY)
-        else:
-            return np_image
+    def as_np_array(self, BGR=False, gray=False, size=None, out=None):
+        """
+        Full size pixels become the stored ones in BGR order, so their changes are frame ones
+        Gray and resized variants are computed once per frame, JPEG ones are decoded
+        from the original bin with the cheapest decoding, so they don't see pixel changes
+        :param size: (width, height) to resize to
+        :param out: array to write full size pixels to instead of returning frame ones,
+            e.g. the other channel order without caching it
+        """
+        if not (gray or size):
+            if out is not None:
+                return self._get_order(BGR, out)
+            # Pixels can be changed by caller, so they become the stored ones, the original bin
+            # isn't valid anymore and the other channel order has to be converted again
+            self._decode()
+            self._set_order(BGR)
+            self._exposed = True
+            self._other = None
+            return self._image
+
+        size = tuple(size) if size else None
+        # Gray doesn't depend on channel order
+        key = (BGR and not gray, gray, size)
+        if key not in self._cache:
+            np_image = self._decode_reduced(BGR, gray, size)
+            if np_image is None:
+                if gray:
+                    np_image, is_bgr = self._get_native()
+                    if np_image is not None and np_image.ndim == 3:
+                        np_image = cv2.cvtColor(
+                            np_image, cv2.COLOR_BGR2GRAY if is_bgr else cv2.COLOR_RGB2GRAY
+                        )
+                else:
+                    np_image = self._get_order(BGR)
+                if np_image is None:
+                    return None
+            if size and np_image.shape[1::-1] != tuple(size):
+                np_image = cv2.resize(np_image, size, interpolation=cv2.INTER_AREA)
+            self._cache[key] = np_image
+        return self._cache[key]
 
     def as_binary(self, BGR=False):
+        if self._binary is not None and not self._exposed and BGR == self._binary_BGR:
+            return self._binary
         np_image_to_encode = self._np_image if BGR else self._np_image_bgr
         return cv2.imencode('.jpg', np_image_to_encode)[1].tobytes()
 
+    def release(self):
+        """
+        Pool buffer goes back to FramePool, frame pixels and their views mustn't be used after it
+        Bin frame is decoded again on the next pixel access, numpy one has no pixels anymore
+        """
+        if not self._pooled:
+            return
+        buffer = self._image
+        self._image = self._other = None
+        self._pooled = False
+        # Cached variants can be views of the buffer (e.g. gray of single channel frame)
+        self._cache = {}
+        self._pool.release(buffer)
+
+    def serialize(self):
+        # Timestamp and JPEG bin, the original bin isn't encoded again if pixels aren't given out
+        BGR = self._binary is not None and self._binary_BGR
+        return _SERIALIZED_HEADER.pack(self._timestamp, BGR) + self.as_binary(BGR)
+
+    @staticmethod
+    def deserialize(data):
+        timestamp, flags = _SERIALIZED_HEADER.unpack_from(data)
+        return Frame(bytes(data[_SERIALIZED_HEADER.size:]), BGR=bool(flags), timestamp=timestamp)
+
+    def get_size(self):
+        # (width, height) without decoding if JPEG header has it, None for corrupted frame
+        if self._image is None and self._binary is not None and not self._corrupted:
+            jpeg_size = get_jpeg_size(self._binary)
+            if jpeg_size:
+                return jpeg_size
+        np_image = self._get_native()[0]
+        return None if np_image is None else np_image.shape[1::-1]
+
+    def get_roi(self, x, y, width, height, BGR=False):
+        """
+        Zero-copy view of region clipped to the frame, its pixel changes are frame ones
+        as full size pixels of BGR order become the stored ones (see as_np_array)
+        :return: numpy view, None for corrupted frame
+        """
+        np_image = self.as_np_array(BGR=BGR)
+        if np_image is None:
+            return None
+        return np_image[max(y, 0):max(y + height, 0), max(x, 0):max(x + width, 0)]
+
+    def resize(self, size, BGR=False, out=None, interpolation=cv2.INTER_AREA):
+        """
+        Resized pixels aren't cached unlike as_np_array(size=...) ones, so caller's buffer
+        can be reused for every frame. JPEG bin is decoded at reduced size if it's possible
+        :param size: (width, height)
+        :param out: uint8 (height, width, channels) array or view to write to, e.g. tensor item
+            or letterbox region, gray frame is converted to colour for 3 channels out
+        :return: out or new array, None for corrupted frame
+        """
+        size = tuple(size)
+        if self.is_corrupted():
+            return None
+        image, is_bgr = self._decode_reduced(BGR, False, size), BGR
+        if image is None:
+            image, is_bgr = self._get_native()
+        if image is None:
+            return None
+        gray_to_colour = image.ndim == 2 and out is not None and out.ndim == 3
+        resized = cv2.resize(
+            image, size, dst=None if gray_to_colour else out, interpolation=interpolation
+        )
+        if gray_to_colour:
+            resized = cv2.cvtColor(resized, cv2.COLOR_GRAY2BGR, dst=out)
+        elif resized.ndim == 3 and is_bgr != BGR:
+            resized = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst=resized)
+        if out is not None and resized is not out:
+            out[:] = resized
+            return out
+        return resized
+
+    def letterbox(self, size, BGR=False, out=None, fill=0, interpolation=cv2.INTER_AREA):
+        """
+        Resizes keeping aspect ratio and pads the rest, only padding is filled in out
+        :param size: (width, height)
+        :param out: uint8 (height, width, 3) array to write to, new one by default
+        :return: (out, scale, (left, top)), frame point is (x * scale + left, y * scale + top)
+            in out, None for corrupted frame
+        """
+        frame_size = self.get_size()
+        if frame_size is None:
+            return None
+        width, height = size
+        scale = min(width / frame_size[0], height / frame_size[1])
+        resized_width = min(width, max(1, round(frame_size[0] * scale)))
+        resized_height = min(height, max(1, round(frame_size[1] * scale)))
+        left = (width - resized_width) // 2
+        top = (height - resized_height) // 2
+        if out is None:
+            out = np.empty((height, width, 3), np.uint8)
+        out[:top] = fill
+        out[top + resized_height:] = fill
+        out[top:top + resized_height, :left] = fill
+        out[top:top + resized_height, left + resized_width:] = fill
+        region = out[top:top + resized_height, left:left + resized_width]
+        if self.resize((resized_width, resized_height), BGR, region, interpolation) is None:
+            return None
+        return out, scale, (left, top)
+
     def copy(self):
-        return Frame(self._np_image.copy())
+        # Timestamp is kept, pixels are copied once in their stored order,
+        # bin is shared as bytes are immutable
+        if self._binary is not None and not (self._exposed and self._image is not None):
+            frame = Frame(self._binary, BGR=self._binary_BGR, timestamp=self._timestamp)
+            frame._corrupted = self._corrupted
+        else:
+            frame = Frame(None, timestamp=self._timestamp)
+        if self._image is not None:
+            # Decoded pixels are kept too, copying is cheaper than decoding them again
+            frame._image = self._image.copy()
+            frame._image_BGR = self._image_BGR
+        return frame
+
+
+class FrameSerializer:
+    # MLQueue spill_serializer: frames are kept as timestamp and JPEG bin, other items are pickled
+    def dumps(self, item):
+        if isinstance(item, Frame):
+            return b'F' + item.serialize()
+        return b'P' + pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        if data[:1] == b'F':
+            return Frame.deserialize(memoryview(data)[1:])
+        return pickle.loads(memoryview(data)[1:])
+
+
+class FrameBatch:
+    """
+    FrameBatch decodes, resizes, colour-converts and normalizes frames in parallel
+    into one preallocated contiguous (N, H, W, C) tensor ready for a model
+    :param frames: Frame objects or bin images, e.g. MLQueue.get() batch
+    :param size: (width, height) of model input
+    :param dtype: np.uint8 or np.float32, float tensor is (image * scale - mean) / std
+    :param executor: thread pool, the shared one by default
+    """
+    def __init__(
+        self, frames, size, BGR=False, dtype=np.uint8, scale=1 / 255, mean=0.0, std=1.0,
+        executor=None
+    ):
+        self._frames = [frame if isinstance(frame, Frame) else Frame(frame) for frame in frames]
+        self._size = tuple(size)
+        self._BGR = BGR
+        self._dtype = np.dtype(dtype)
+        self._scale = scale
+        self._mean = mean
+        self._std = std
+        self._executor = executor or _get_executor()
+        self._tensor = None
+        self._corrupted = []
+
+    def _preprocess(self, index):
+        frame = self._frames[index]
+        if frame.is_corrupted():
+            return False
+        out = self._tensor[index]
+        if self._dtype == np.uint8:
+            return frame.resize(self._size, self._BGR, out) is not None
+        resized = frame.resize(self._size, self._BGR)
+        if resized is None:
+            return False
+        if resized.ndim == 2:
+            resized = cv2.cvtColor(resized, cv2.COLOR_GRAY2BGR)
+        np.multiply(resized, self._scale, out=out, casting='unsafe')
+        out -= self._mean
+        out /= self._std
+        return True
+
+    def as_tensor(self):
+        if self._tensor is None:
+            width, height = self._size
+            self._tensor = np.zeros((len(self), height, width, 3), self._dtype)
+            results = self._executor.map(self._preprocess, range(len(self)))
+            self._corrupted = [index for index, result in enumerate(results) if not result]
+        return self._tensor
+
+    def get_corrupted(self):
+        # Indices of corrupted frames, their tensor items are zeros
+        self.as_tensor()
+        return self._corrupted
+
+    def get_frames(self):
+        return self._frames
+
+    def __len__(self):
+        return len(self._frames)
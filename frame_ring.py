@@ -0,0 +1,110 @@
+import logging
+import mmap
+import os
+
+import numpy as np
+
+from .frame import Frame  # noqa
+
+logger = logging.getLogger('frame-ring')
+
+
+class SharedFrame(Frame):
+    """
+    SharedFrame points at FrameRing slot without copying,
+    it's valid until producer overwrites the slot
+    """
+    def __init__(self, image, ring, slot, seq, timestamp):
+        single_channel = image.ndim == 2
+        super().__init__(
+            image, BGR=not single_channel, single_channel=single_channel, timestamp=timestamp
+        )
+        self._ring = ring
+        self._slot = slot
+        self._seq = seq
+
+    def get_seq(self):
+        return self._seq
+
+    def is_overwritten(self):
+        return self._ring._seqs[self._slot] != self._seq
+
+
+class FrameRing:
+    """
+    FrameRing is fixed-slot ring of BGR frames in shared memory (memory-mapped file in /dev/shm)
+    to pass frames between processes
+    Producer never blocks and overwrites the oldest slot (latest wins, as LifoQueue does),
+    every slot keeps sequence number so readers can detect overwritten frames
+    :param name: shared memory name, the same for producer and consumers
+    :param slots: number of frames in the ring
+    :param shape: frame shape, (height, width, 3) or (height, width) for gray
+    :param create: producer creates shared memory, consumers attach to it
+    :param directory: tmpfs directory for shared memory files
+    """
+    def __init__(self, name, slots, shape, create=True, directory='/dev/shm'):
+        self._name = name
+        self._slots = slots
+        self._shape = tuple(shape)
+        header_size = 8 * (2 * slots + 1)
+        frame_size = int(np.prod(self._shape))
+        size = header_size + frame_size * slots
+        self._path = os.path.join(directory, name)
+        with open(self._path, 'w+b' if create else 'r+b') as file:
+            if create:
+                file.truncate(size)
+            self._memory = mmap.mmap(file.fileno(), size)
+        buffer = self._memory
+        self._head = np.ndarray((1,), np.int64, buffer)
+        self._seqs = np.ndarray((slots,), np.int64, buffer, offset=8)
+        self._timestamps = np.ndarray((slots,), np.float64, buffer, offset=8 * (slots + 1))
+        self._data = np.ndarray((slots,) + self._shape, np.uint8, buffer, offset=header_size)
+        if create:
+            self._head[0] = 0
+            self._seqs[:] = 0
+
+    def put(self, frame):
+        # Camera is able to use the ring as its queue
+        image, is_bgr = frame._get_native()
+        if image is not None and not is_bgr and image.ndim == 3:
+            image = image[:, :, ::-1]
+        if image is None or image.shape != self._shape:
+            logger.info(f'{self._name} frame ring got frame of wrong shape, your put is skipped')
+            return None
+        seq = int(self._head[0]) + 1
+        slot = (seq - 1) % self._slots
+        self._seqs[slot] = -seq  # Slot is being written
+        self._data[slot] = image
+        self._timestamps[slot] = frame.get_time()
+        self._seqs[slot] = seq
+        self._head[0] = seq
+        return seq
+
+    def get(self, seq=None):
+        """
+        :param seq: sequence number of frame, the latest one by default
+        :return: SharedFrame or None if there is no such frame in the ring anymore
+        """
+        if seq is None:
+            seq = int(self._head[0])
+        if seq < 1:
+            return None
+        slot = (seq - 1) % self._slots
+        frame = SharedFrame(self._data[slot], self, slot, seq, float(self._timestamps[slot]))
+        if frame.is_overwritten():
+            return None
+        return frame
+
+    def get_seq(self):
+        return int(self._head[0])
+
+    def close(self):
+        # Arrays keep the mapping alive, it's unmapped when the last SharedFrame is released,
+        # explicit mmap.close() would leave them dangling
+        self._head = self._seqs = self._timestamps = self._data = self._memory = None
+
+    def unlink(self):
+        os.unlink(self._path)
+
+    def __len__(self):
+        return min(self.get_seq(), self._slots)
@@ -0,0 +1,130 @@
+import threading
+import logging
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('metrics')
+
+MS_BUCKETS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class Metrics:
+    """
+    Metrics is registry of counters, gauges and histograms labeled by ML queue id, camera name, etc.
+    It's turned off unless instance is passed to Camera/MLQueue (and set to Frame.metrics),
+    so disabled metrics cost one attribute check
+    :param prefix: prefix of metric names
+    """
+    def __init__(self, prefix='pycv'):
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._buckets = {}
+        self._server = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, buckets=None, **labels):
+        # Buckets are MS_BUCKETS for *_ms names and SIZE_BUCKETS for others by default
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                if buckets is None:
+                    buckets = MS_BUCKETS if name.endswith('_ms') else SIZE_BUCKETS
+                self._buckets.setdefault(name, buckets)
+                # Bucket counts (the last one is +Inf), sum and count
+                histogram = self._histograms[key] = [0] * (len(self._buckets[name]) + 1) + [0, 0]
+            histogram[bisect_left(self._buckets[name], value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def get(self, name, **labels):
+        # Counter or gauge value, histogram count
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key][-1]
+            return self._counters.get(key, self._gauges.get(key))
+
+    def _format_labels(self, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join(
+            f'{name}="{self._escape(value)}"' for name, value in labels
+        ) + '}'
+
+    @staticmethod
+    def _escape(value):
+        # Label value escaping of exposition format: backslash, double quote and line feed
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        with self._lock:
+            for metrics, metric_type, suffix in [
+                (self._counters, 'counter', '_total'),
+                (self._gauges, 'gauge', '')
+            ]:
+                declared = set()
+                for (name, labels), value in sorted(metrics.items()):
+                    full_name = f'{self._prefix}_{name}{suffix}'
+                    if name not in declared:
+                        lines.append(f'# TYPE {full_name} {metric_type}')
+                        declared.add(name)
+                    lines.append(f'{full_name}{self._format_labels(labels)} {value}')
+
+            declared = set()
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                full_name = f'{self._prefix}_{name}'
+                if name not in declared:
+                    lines.append(f'# TYPE {full_name} histogram')
+                    declared.add(name)
+                cumulative = 0
+                bounds = list(self._buckets[name]) + ['+Inf']
+                for bound, count in zip(bounds, histogram):
+                    cumulative += count
+                    bucket_labels = self._format_labels(labels, [('le', bound)])
+                    lines.append(f'{full_name}_bucket{bucket_labels} {cumulative}')
+                lines.append(f'{full_name}_sum{self._format_labels(labels)} {histogram[-2]}')
+                lines.append(f'{full_name}_count{self._format_labels(labels)} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info(f'metrics are served on {host}:{self._server.server_port}')
+        return self._server
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
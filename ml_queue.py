@@ -1,16 +1,273 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import math
+import pickle
 import queue
 import logging
+import struct
+import sys
+import time
 
 logger = logging.getLogger('ml-queue')
 
+# Spill record header: length of pickled source, then source and item serialized by spill_serializer
+_SPILL_SOURCE = struct.Struct('<H')
 
-class MLQueue:
-    # Queue is a way to communicate with ML
+
+def get_nbytes(item):
+    # Default byte budget sizer: nbytes of Frame or numpy array, bin length, object size
+    nbytes = getattr(item, 'nbytes', None)
+    if nbytes is not None:
+        return nbytes
+    if isinstance(item, (bytes, bytearray)):
+        return len(item)
+    return sys.getsizeof(item)
+
+
+class _BulkLifoQueue(queue.LifoQueue):
+    # LifoQueue which puts, gets and discards many items under a single lock acquisition
+    # With max_bytes queue is limited by sum of item sizes too, sizes are taken on put
+    def __init__(self, maxsize=0, max_bytes=None, sizer=get_nbytes):
+        self.max_bytes = max_bytes
+        self._sizer = sizer if max_bytes else None
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self.sizes = []
+        self.nbytes = 0
+
+    def full(self):
+        with self.mutex:
+            return 0 < self.maxsize <= self._qsize() or \
+                self.max_bytes is not None and self.nbytes >= self.max_bytes
+
+    @staticmethod
+    def _count_newest(sizes, free_bytes):
+        # Number of the latest items which fit to free bytes
+        count = 0
+        for size in reversed(sizes):
+            free_bytes -= size
+            if free_bytes < 0:
+                break
+            count += 1
+        return count
+
+    def put_many(self, items, source=None, dropped=None):
+        # Latest items win as they are on top: items which don't fit are skipped from the start
+        # of items, if dropped list is passed the oldest queue items are dropped to make room
+        with self.not_full:
+            sizes = [self._sizer(item) for item in items] if self._sizer else None
+            count = len(items) if self.maxsize <= 0 else min(len(items), self.maxsize)
+            free = self.maxsize - self._qsize() if self.maxsize > 0 else count
+            if sizes is not None:
+                count = min(count, self._count_newest(sizes, self.max_bytes))
+            if dropped is None:
+                count = min(count, max(free, 0))
+                if sizes is not None:
+                    count = min(count, self._count_newest(sizes, self.max_bytes - self.nbytes))
+            items = items[len(items) - count:]
+            sizes = sizes[len(sizes) - count:] if sizes is not None else None
+            nbytes = sum(sizes) if sizes is not None else 0
+            if dropped is not None:
+                overflow_bytes = self.nbytes + nbytes - self.max_bytes if sizes is not None else 0
+                if count > free or overflow_bytes > 0:
+                    self._drop_oldest(max(count - free, 0), dropped, overflow_bytes)
+            self._put_many(items, source, sizes)
+            self.nbytes += nbytes
+            self.unfinished_tasks += count
+            self.not_empty.notify(count)
+            return count
+
+    def _put(self, item):
+        sizes = [self._sizer(item)] if self._sizer else None
+        self._put_many([item], None, sizes)
+        self.nbytes += sizes[0] if sizes else 0
+
+    def _get(self):
+        return self._get_many(1, 0, None)[0]
+
+    def _put_many(self, items, source, sizes):
+        self.queue.extend(items)
+        if sizes is not None:
+            self.sizes.extend(sizes)
+
+    def get_many(self, count, block=True, skip=0, timeout=None, dropped=None):
+        # Discards skip items from the top and then returns next count items (top first)
+        # If timeout is set, it waits for them no more than timeout seconds and returns what it has
+        # Discarded items are added to dropped list if it's passed
+        with self.not_empty:
+            if block:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while self._qsize() < skip + count:
+                    if deadline is None:
+                        self.not_empty.wait()
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.not_empty.wait(remaining)
+            size = self._qsize()
+            count = min(count, size)
+            skip = min(skip, size - count)
+            items = self._get_many(count, skip, dropped)
+            self.not_full.notify(skip + count)
+            return items
+
+    def _get_many(self, count, skip, dropped):
+        end = len(self.queue) - skip
+        if dropped is not None:
+            dropped.extend(self.queue[end:])
+        items = self.queue[end - count:end]
+        items.reverse()
+        del self.queue[end - count:]
+        if self._sizer:
+            self.nbytes -= sum(self.sizes[end - count:])
+            del self.sizes[end - count:]
+        return items
+
+    def _drop_oldest(self, count, dropped, nbytes=0):
+        # Drops at least count items and at least nbytes
+        freed = sum(self.sizes[:count]) if self._sizer else 0
+        while freed < nbytes and count < len(self.queue):
+            freed += self.sizes[count]
+            count += 1
+        if dropped is not None:
+            dropped.extend(self.queue[:count])
+        del self.queue[:count]
+        if self._sizer:
+            del self.sizes[:count]
+            self.nbytes -= freed
+        self.not_full.notify(count)
+
+    def clear(self, dropped=None):
+        # Removed items are added to dropped list if it's passed
+        with self.mutex:
+            self._clear(dropped)
+            self.not_full.notify_all()
+
+    def _clear(self, dropped):
+        if dropped is not None:
+            dropped.extend(self.queue)
+        self.queue.clear()
+        self.sizes.clear()
+        self.nbytes = 0
+
+
+class _MultiSourceQueue(_BulkLifoQueue):
+    # Sub-queue per source, so a busy source doesn't crowd out the others:
+    # items are taken by deficit round-robin weighted by source priorities (the latest
+    # items of each source first), dilution drops the oldest items of the most overloaded
+    # sources, i.e. ones with the most items per priority unit
+    def __init__(self, maxsize, priorities=None, max_bytes=None, sizer=get_nbytes):
+        self._priorities = dict(priorities or {})
+        if any(priority <= 0 for priority in self._priorities.values()):
+            raise ValueError('Source priority has to be positive')
+        super().__init__(maxsize, max_bytes, sizer)
+
+    def _init(self, maxsize):
+        # (item, size) pairs, the newest items are on the right,
+        # the next source in round is the first one
+        self.queues = collections.OrderedDict()
+        self._deficits = {}
+        self._current = None
+        self._size = 0
+        self.nbytes = 0
+
+    def _qsize(self):
+        return self._size
+
+    def set_priority(self, source, priority):
+        if priority <= 0:
+            raise ValueError('Source priority has to be positive')
+        with self.mutex:
+            self._priorities[source] = priority
+
+    def get_sizes(self):
+        with self.mutex:
+            return {source: len(items) for source, items in self.queues.items() if items}
+
+    def _put_many(self, items, source, sizes):
+        if source not in self.queues:
+            self.queues[source] = collections.deque()
+            self._deficits[source] = 0.0
+        self.queues[source].extend(zip(items, sizes or [0] * len(items)))
+        self._size += len(items)
+
+    def _pop(self, source_items, newest):
+        item, size = source_items.pop() if newest else source_items.popleft()
+        self._size -= 1
+        self.nbytes -= size
+        return item, size
+
+    def _get_load(self, source):
+        return len(self.queues[source]) / self._priorities.get(source, 1)
+
+    def _drop_oldest(self, count, dropped, nbytes=0):
+        self._drop_overloaded(count, dropped, nbytes)
+        self.not_full.notify(count)
+
+    def _drop_overloaded(self, count, dropped, nbytes=0):
+        # Drops at least count items and at least nbytes, heap of sources by load
+        # makes it O(count * log(sources))
+        heap = [
+            (-self._get_load(source), index, source) for index, source in enumerate(self.queues)
+        ]
+        heapq.heapify(heap)
+        freed = 0
+        while (count > 0 or freed < nbytes) and self._size:
+            load, order, source = heap[0]
+            item, size = self._pop(self.queues[source], newest=False)
+            if dropped is not None:
+                dropped.append(item)
+            heapq.heapreplace(heap, (-self._get_load(source), order, source))
+            count -= 1
+            freed += size
+
+    def _get_many(self, count, skip, dropped):
+        self._drop_overloaded(skip, dropped)
+        items = []
+        while len(items) < count:
+            source = next(iter(self.queues))
+            source_items = self.queues[source]
+            if not source_items:
+                # Drained source leaves the round, its deficit isn't kept (DRR)
+                del self.queues[source], self._deficits[source]
+                self._current = None
+                continue
+            if source != self._current:
+                # Batch can end in the middle of source turn, next batch continues it
+                self._current = source
+                self._deficits[source] += self._priorities.get(source, 1)
+            while source_items and self._deficits[source] >= 1 and len(items) < count:
+                items.append(self._pop(source_items, newest=True)[0])
+                self._deficits[source] -= 1
+            if not source_items:
+                self._deficits[source] = 0.0
+            if not source_items or self._deficits[source] < 1:
+                self.queues.move_to_end(source)
+                self._current = None
+        return items
+
+    def _clear(self, dropped):
+        if dropped is not None:
+            for source_items in self.queues.values():
+                dropped.extend(item for item, size in source_items)
+        self._init(self.maxsize)
+
+
+class StepBalancer:
+    """
+    StepBalancer changes batch size step by step with queue load until balancer_threshold %,
+    dilution grows with load above it. In byte budget mode (max_bytes config) items in load
+    percent are estimated from the current items footprint
+    :param queue_id: MLQueue id for logs
+    :param config: MLQueue config
+    """
     def __init__(self, queue_id, config):
         self._id = queue_id
-        self._max_size = config['max_size']
-        self._queue = queue.LifoQueue(self._max_size)
-
         self._balancer_threshold = config.get('balancer_threshold', 50)
         self._balancer_step = config.get('balancer_step', 5)
         self._balancer_step_log = config.get('balancer_step_log', 10)
@@ -20,7 +277,8 @@ class MLQueue:
         self._prev_batch_size_load = 0
         self._dilution = 1
         self._dilution_multiplier = config.get('balancer_dilution_backward_purge', 10)
-        self._items_in_percent = self._max_size / 100
+        self._items_in_percent = config.get('max_size', 0) / 100
+        self._by_bytes = bool(config.get('max_bytes'))
         self._prev_dilution_load = 0
 
     def _calculate_batch_size(self, load, diff):
@@ -62,9 +320,10 @@ class MLQueue:
                 f'dilution is {status} ({self._dilution} now)'
             )
 
-    def _balance(self):
-        size = len(self)
-        load = round(size / self._max_size * 100)
+    def update(self, items, load, now):
+        load = round(load * 100)
+        if self._by_bytes and load:
+            self._items_in_percent = items / load
         batch_size_load = None
         batch_size_threshold_ratio = 100 / self._balancer_threshold
         dilution_load = None
@@ -89,66 +348,464 @@ class MLQueue:
             self._calculate_dilution(load, dilution_load_diff)
             self._prev_dilution_load = dilution_load
 
-        if not len(self):
+        if not items:
             self._batch_size_float = 0.0
             self._prev_batch_size_load = 0
             self._dilution = 1
             self._prev_dilution_load = 0
 
-        if self._queue.full():
-            self._queue.queue.clear()
-            logger.info(f'{self._id} ML queue was fully loaded and cleared')
+    def observe_get(self, count, now):
+        pass
+
+    def get_batch_size(self):
+        return round(self._batch_size_float)
+
+    def get_dilution(self):
+        return self._dilution
+
+
+class LatencyBalancer:
+    """
+    LatencyBalancer keeps queue latency (time item waits for consumer) under target latency,
+    latency is estimated by Little's law as queue size / measured consumer throughput
+    Batch size is AIMD controlled: it's increased additively while latency is above target
+    (bigger batches give more GPU throughput) and decreased multiplicatively when latency is
+    below low_ratio * target. When batch size is the max one, items which can't be consumed
+    within target latency are dropped by dilution
+    :param max_batch_size: batch size limit
+    :param target_latency: seconds
+    :param interval: seconds between batch size steps
+    :param batch_size_increase: items added to batch size per step, max_batch_size / 8 by default
+    :param decrease: factor of batch size multiplicative decrease
+    :param low_ratio: latency band [low_ratio * target, target] where batch size isn't changed
+    :param smoothing: throughput EWMA weight of new measurement
+    """
+    def __init__(
+        self, max_batch_size, target_latency=0.5, interval=0.1, batch_size_increase=None,
+        decrease=0.5, low_ratio=0.5, smoothing=0.3
+    ):
+        self._max_batch_size = max_batch_size
+        self._target_latency = target_latency
+        self._interval = interval
+        self._batch_size_increase = batch_size_increase or max(1, max_batch_size // 8)
+        self._decrease = decrease
+        self._low_ratio = low_ratio
+        self._smoothing = smoothing
+        self._batch_size = 1
+        self._dilution = 1
+        self._throughput = None
+        self._consumed = 0
+        self._backlogged = True
+        self._step_time = None
+
+    def observe_get(self, count, now):
+        self._consumed += count
+
+    def _update_throughput(self, now):
+        # Consumer capacity is measured only if it had items all the time,
+        # otherwise it's just arrival rate
+        if self._backlogged and self._consumed:
+            throughput = self._consumed / (now - self._step_time)
+            if self._throughput is None:
+                self._throughput = throughput
+            else:
+                self._throughput += self._smoothing * (throughput - self._throughput)
+        self._consumed = 0
+        self._backlogged = True
+
+    def get_latency(self, size):
+        # Estimated seconds for the last item to be consumed, None until throughput is measured
+        if not size:
+            return 0.0
+        if self._throughput is None:
+            return None
+        return size / self._throughput
+
+    def _update_batch_size(self, size):
+        latency = self.get_latency(size)
+        if latency is None:
+            return
+        if latency > self._target_latency:
+            self._batch_size = min(
+                self._batch_size + self._batch_size_increase, self._max_batch_size
+            )
+        elif latency < self._target_latency * self._low_ratio:
+            self._batch_size = max(1, math.floor(self._batch_size * self._decrease))
+
+    def _get_dilution(self, size):
+        if self._throughput is None or self._batch_size < self._max_batch_size:
+            return 1
+        excess = size - self._throughput * self._target_latency
+        return math.ceil(excess) + 1 if excess > 0 else 1
+
+    def update(self, items, load, now):
+        if not items:
+            self._backlogged = False
+        if self._step_time is None:
+            self._step_time = now
+        elif now - self._step_time >= self._interval:
+            self._update_throughput(now)
+            self._step_time = now
+            self._update_batch_size(items)
+        # Dilution follows every queue change, otherwise it'd drop items twice
+        self._dilution = self._get_dilution(items)
+
+    def get_batch_size(self):
+        return self._batch_size
+
+    def get_dilution(self):
+        return self._dilution
+
+
+class _Source:
+    # Queue-like handle which puts items to MLQueue on behalf of the source, e.g. for Camera
+    def __init__(self, ml_queue, source):
+        self._ml_queue = ml_queue
+        self._source = source
 
     def put(self, items):
-        if self._queue.full():
+        return self._ml_queue.put(items, source=self._source)
+
+
+class MLQueue:
+    """
+    Queue is a way to communicate with ML
+    With multi_source config items are kept per source (get_source(...).put or put(source=...)),
+    so busy sources don't crowd out the others, batch size balancer works with the whole queue
+    With max_bytes config queue is limited by memory footprint of items (Frame.nbytes, numpy
+    array nbytes or config sizer(item) result), max_size items limit is optional then
+    Batch size and dilution (every dilution-th item is given out, the rest are dropped)
+    are controlled by config balancer, StepBalancer by default. Balancer is any object with
+    update(items, load, now), observe_get(count, now), get_batch_size() and get_dilution(),
+    load is a fraction of the queue limit (bytes or items), now is config clock time
+    (time.monotonic by default)
+    Fully loaded queue is cleared by default, with overflow 'drop_oldest' config the oldest
+    items are dropped to make room for new ones
+    With spill config (e.g. SpillLog) items above spill_high_water load go to disk instead, they
+    are serialized by spill_serializer (pickle by default, FrameSerializer keeps frames as JPEG)
+    and drained back in order (the oldest first) when load falls below spill_low_water
+    on_drop config is called with list of items which leave the queue without being given out
+    (dilution, overflow, clearing, skipped and spilled puts), e.g. frame.release_frames returns
+    their FramePool buffers (the latest of them can be Camera.frame too, it has no pixels then)
+    """
+    def __init__(self, queue_id, config):
+        self._id = queue_id
+        self._max_bytes = config.get('max_bytes')
+        self._max_size = config.get('max_size', 0) if self._max_bytes else config['max_size']
+        sizer = config.get('sizer') or get_nbytes
+        if config.get('multi_source'):
+            self._queue = _MultiSourceQueue(
+                self._max_size, config.get('source_priorities'), self._max_bytes, sizer
+            )
+        else:
+            self._queue = _BulkLifoQueue(self._max_size, self._max_bytes, sizer)
+        self._max_batch_size = config['max_batch_size']
+        self._balancer = config.get('balancer') or StepBalancer(queue_id, config)
+        self._clock = config.get('clock', time.monotonic)
+        self._overflow = config.get('overflow', 'clear')
+        if self._overflow not in ('clear', 'drop_oldest'):
+            raise ValueError(f'Unknown overflow policy {self._overflow}')
+        self._metrics = config.get('metrics')
+        self._on_drop = config.get('on_drop')
+        self._spill = config.get('spill')
+        self._spill_serializer = config.get('spill_serializer') or pickle
+        self._spill_high_water = config.get('spill_high_water', 0.8)
+        self._spill_low_water = config.get('spill_low_water', 0.5)
+        # Spill log can have items recovered after crash
+        self._drain_spill()
+
+    # StepBalancer state as it was MLQueue one
+    @property
+    def _dilution(self):
+        return self._balancer.get_dilution()
+
+    @property
+    def _prev_batch_size_load(self):
+        return self._balancer._prev_batch_size_load
+
+    @property
+    def _prev_dilution_load(self):
+        return self._balancer._prev_dilution_load
+
+    @property
+    def _items_in_percent(self):
+        return self._balancer._items_in_percent
+
+    def get_load(self):
+        # Fraction of the queue limit, the tighter one of bytes and items
+        load = self._queue.nbytes / self._max_bytes if self._max_bytes else 0.0
+        if self._max_size:
+            load = max(load, len(self) / self._max_size)
+        return load
+
+    def get_nbytes(self):
+        return self._queue.nbytes
+
+    def _balance(self):
+        load = self.get_load()
+        self._balancer.update(len(self), load, self._clock())
+
+        if self._overflow == 'clear' and self._spill is None and self._queue.full():
+            if self._metrics:
+                self._metrics.inc('queue_cleared_items', len(self), queue=self._id)
+            dropped = [] if self._on_drop else None
+            self._queue.clear(dropped)
+            self._drop(dropped)
+            logger.info(f'{self._id} ML queue was fully loaded and cleared')
+
+        if self._metrics:
+            self._metrics.set('queue_depth', len(self), queue=self._id)
+            self._metrics.set('queue_load_percent', round(load * 100), queue=self._id)
+            if self._max_bytes:
+                self._metrics.set('queue_bytes', self._queue.nbytes, queue=self._id)
+            self._metrics.set('queue_batch_size', self.get_batch_size(), queue=self._id)
+            self._metrics.set('queue_dilution', self._dilution, queue=self._id)
+        self._drain_spill()
+
+    def _drop(self, items):
+        if items and self._on_drop:
+            try:
+                self._on_drop(items)
+            except Exception as ex:
+                logger.exception(f'{self._id} ML queue on_drop failed')
+
+    def _is_spilling(self):
+        # Once spilling is started new items go to disk until it's drained, so order is kept
+        return self._spill is not None and (
+            len(self._spill) or self.get_load() >= self._spill_high_water
+        )
+
+    def _spill_items(self, items, source):
+        # Returns number of items which are skipped as spill is full or they can't be serialized
+        records = []
+        source_header = pickle.dumps(source, pickle.HIGHEST_PROTOCOL)
+        source_header = _SPILL_SOURCE.pack(len(source_header)) + source_header
+        for item in items:
+            try:
+                records.append(source_header + self._spill_serializer.dumps(item))
+            except Exception as ex:
+                logger.info(f'{self._id} ML queue item can\'t be spilled: {ex}')
+        count = self._spill.append_many(records)
+        if count < len(records):
+            logger.info(f'{self._id} ML queue spill is full, {len(records) - count} items skipped')
+        if self._metrics:
+            self._metrics.inc('queue_spilled_items', count, queue=self._id)
+            self._metrics.set('queue_spill_items', len(self._spill), queue=self._id)
+        return len(items) - count
+
+    def _load_spilled(self, record):
+        length = _SPILL_SOURCE.unpack_from(record)[0]
+        start = _SPILL_SOURCE.size + length
+        source = pickle.loads(record[_SPILL_SOURCE.size:start])
+        return source, self._spill_serializer.loads(record[start:])
+
+    def _drain_spill(self):
+        if self._spill is None or not len(self._spill) or \
+                self.get_load() >= self._spill_low_water:
+            return
+        drained = 0
+        while len(self._spill) and self.get_load() < self._spill_high_water:
+            # Items which fit under high water mark, byte budget one is unknown until loading
+            count = 1
+            if self._max_size and not self._max_bytes:
+                count = max(1, int(self._max_size * self._spill_high_water) - len(self))
+            spilled = []
+            for record in self._spill.read_many(min(count, self._max_batch_size)):
+                try:
+                    spilled.append(self._load_spilled(record))
+                except Exception as ex:
+                    logger.info(f'{self._id} ML queue spilled item can\'t be loaded: {ex}')
+            for source, group in itertools.groupby(spilled, lambda pair: pair[0]):
+                items = [item for source, item in group]
+                count = self._queue.put_many(items, source)
+                drained += count
+                if count < len(items):
+                    self._drop(items[:len(items) - count])
+                    if self._metrics:
+                        self._metrics.inc(
+                            'queue_put_skipped', len(items) - count, queue=self._id
+                        )
+        if self._metrics:
+            self._metrics.inc('queue_spill_drained', drained, queue=self._id)
+            self._metrics.set('queue_spill_items', len(self._spill), queue=self._id)
+
+    def get_spilled(self):
+        # Number of items on disk
+        return len(self._spill) if self._spill is not None else 0
+
+    def put(self, items, source=None):
+        items = items if isinstance(items, list) else [items]
+        # Overflow policy drop_oldest, new items aren't skipped, the oldest ones are dropped
+        dropped = [] if self._overflow == 'drop_oldest' else None
+        if self._is_spilling():
+            skipped = self._spill_items(items, source)
+            # Spilled items are restored from their serialized copies
+            self._drop(items)
+        elif dropped is None and self._queue.full():
             logger.info(f'{self._id} ML queue is fully loaded, your put is skipped')
+            skipped = len(items)
+            self._drop(items)
         else:
-            if isinstance(items, list):
-                for item in items:
-                    self._queue.put(item)
-            else:
-                self._queue.put(items)
+            count = self._queue.put_many(items, source, dropped)
+            if dropped:
+                logger.info(
+                    f'{self._id} ML queue is fully loaded, {len(dropped)} oldest items are dropped'
+                )
+                if self._metrics:
+                    self._metrics.inc('queue_overflow_drops', len(dropped), queue=self._id)
+            skipped = len(items) - count
+            removed = (dropped or []) + items[:skipped]
+            if skipped and self._spill is not None:
+                # Items which don't fit go to disk instead
+                skipped = self._spill_items(items[:skipped], source)
+            self._drop(removed)
+            if skipped:
+                logger.info(
+                    f'{self._id} ML queue is almost fully loaded, '
+                    f'{skipped} oldest items of your put are skipped'
+                )
+            if self._metrics:
+                self._metrics.inc('queue_items_put', count, queue=self._id)
             self._balance()
+        if skipped and self._metrics:
+            self._metrics.inc('queue_put_skipped', skipped, queue=self._id)
 
-    def _dilute(self, batch):
-        # It's necessary to gather all queue items in array
-        # otherwise next put will be earlier than last loop iteration (strange Python behavior)
-        # By memory consuption it's the same as solution without aggregation (one by one),
-        # tested
-        if self._dilution > 1:
-            results = []
-            for index in range(0, self._dilution):
-                results.append(self._queue.get())
-            return results[-1:]
+    def _get_many(self, count, block, skip=0, timeout=None):
+        dropped = [] if (self._metrics or self._on_drop) and skip else None
+        items = self._queue.get_many(count, block, skip, timeout, dropped)
+        self._drop(dropped)
+        self._balancer.observe_get(len(items), self._clock())
+        if self._metrics:
+            if dropped:
+                self._metrics.inc('queue_dilution_drops', len(dropped), queue=self._id)
+            self._metrics.observe('queue_get_items', len(items), queue=self._id)
+        return items
+
+    def _dilute(self, batch, wait):
+        # Dilution and batches are taken under one queue lock, it's O(1) lock acquisitions
+        # instead of one per item
+        dilution = self._balancer.get_dilution()
+        if dilution > 1:
+            return self._get_many(1, wait, skip=dilution - 1)
         elif batch:
-            results = []
-            batch_size = self.get_batch_size()
-            if batch_size:
-                for index in range(0, batch_size):
-                    results.append(self._queue.get())
-            else:
-                results.append(self._queue.get())
-            return results
+            return self._get_many(self.get_batch_size() or 1, wait)
         else:
-            return [self._queue.get()]
+            return self._get_many(1, wait)
+
+    def _observe_wait(self, start_time):
+        if self._metrics:
+            wait_ms = (time.monotonic() - start_time) * 1000
+            self._metrics.observe('queue_wait_ms', wait_ms, queue=self._id)
 
     def get(self, size=1, auto_batch_size=True, wait=False):
         result = []
+        start_time = time.monotonic()
+        self._drain_spill()
         if len(self) or wait:
             if size > 1:
                 items = []
                 for counter in range(0, size):
                     items.append(
-                        self._dilute(auto_batch_size)
+                        self._dilute(auto_batch_size, wait)
                     )
                 result = items
             else:
-                result = self._dilute(auto_batch_size)
+                result = self._dilute(auto_batch_size, wait)
+            self._observe_wait(start_time)
             self._balance()
         return result
 
+    def get_batch(self, max_size=None, max_latency_ms=0):
+        """
+        Gathers items until batch is full or deadline passes, partial batch is returned on timeout,
+        by default it doesn't wait and returns up to max_size items which are in the queue
+        (AsyncMLQueue.get_batch does the same)
+        :param max_size: batch size, max_batch_size by default
+        :param max_latency_ms: time to wait for the batch
+        """
+        start_time = time.monotonic()
+        self._drain_spill()
+        result = self._get_many(
+            max_size or self._max_batch_size,
+            True,
+            skip=self._balancer.get_dilution() - 1,
+            timeout=max_latency_ms / 1000
+        )
+        self._observe_wait(start_time)
+        self._balance()
+        return result
+
     def get_batch_size(self):
-        return round(self._batch_size_float)
+        return self._balancer.get_batch_size()
+
+    def get_source(self, source, priority=None):
+        """
+        :param source: source key, e.g. camera name
+        :param priority: source weight in batches and dilution, 1 by default
+        :return: handle to pass as camera queue
+        """
+        self._check_multi_source()
+        if priority is not None:
+            self._queue.set_priority(source, priority)
+        return _Source(self, source)
+
+    def get_source_sizes(self):
+        self._check_multi_source()
+        return self._queue.get_sizes()
+
+    def _check_multi_source(self):
+        if not isinstance(self._queue, _MultiSourceQueue):
+            raise ValueError(f'{self._id} ML queue is not multi_source')
 
     def __len__(self):
         return self._queue.qsize()
+
+
+class AsyncMLQueue(MLQueue):
+    # MLQueue for asyncio apps, waiting consumers don't hold threads
+    # Items have to be put from the event loop (e.g. by AsyncCamera)
+    def __init__(self, queue_id, config):
+        super().__init__(queue_id, config)
+        self._items_put = asyncio.Event()
+
+    async def put(self, items, source=None):
+        super().put(items, source)
+        if len(self):
+            self._items_put.set()
+
+    async def _wait_items_put(self, timeout=None):
+        self._items_put.clear()
+        try:
+            await asyncio.wait_for(self._items_put.wait(), timeout)
+        except asyncio.TimeoutError as ex:
+            return False
+        return True
+
+    async def get_batch(self, max_size=None, max_latency_ms=0):
+        """
+        The same as MLQueue.get_batch, waiting doesn't block the event loop
+        :param max_size: batch size, max_batch_size by default
+        :param max_latency_ms: time to wait for the batch
+        """
+        self._drain_spill()
+        max_size = max_size or self._max_batch_size
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_latency_ms / 1000
+        while len(self) < max_size + self._balancer.get_dilution() - 1:
+            remaining = deadline - loop.time()
+            if remaining <= 0 or not await self._wait_items_put(remaining):
+                break
+        return super().get_batch(max_size)
+
+    async def _get_balanced(self):
+        # Iteration waits for items and gives batches sized by balancer
+        self._drain_spill()
+        while not len(self):
+            await self._wait_items_put()
+        return self.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._get_balanced()
@@ -0,0 +1,52 @@
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    """
+    MotionGate passes only frames which differ from the last passed one, so static scenes
+    don't load ML pipeline. Frames are compared as small gray images (JPEG is decoded
+    at reduced size in grayscale, it's cheap)
+    :param threshold: part of pixels which have to change to pass frame
+    :param pixel_threshold: gray level difference of changed pixel, it's above sensor noise
+    :param keyframe_interval: seconds, frame is passed anyway if nothing has passed for so long
+    :param size: (width, height) of compared images
+    """
+    def __init__(self, threshold=0.01, pixel_threshold=15, keyframe_interval=10, size=(64, 36)):
+        self._threshold = threshold
+        self._pixel_threshold = pixel_threshold
+        self._keyframe_interval = keyframe_interval
+        self._size = tuple(size)
+        self._last_image = None
+        self._last_time = None
+        self._score = None
+
+    def get_score(self, frame):
+        # Part of changed pixels against the last passed frame, None if there is nothing to compare
+        image = frame.as_np_array(gray=True, size=self._size)
+        if image is None or self._last_image is None:
+            return None
+        diff = cv2.absdiff(image, self._last_image)
+        return np.count_nonzero(diff > self._pixel_threshold) / diff.size
+
+    def check(self, frame):
+        # True if frame has to be passed, corrupted frames aren't passed
+        image = frame.as_np_array(gray=True, size=self._size)
+        if image is None:
+            return False
+        self._score = self.get_score(frame)
+        timestamp = frame.get_time()
+        passed = self._score is None or self._score >= self._threshold \
+            or timestamp - self._last_time >= self._keyframe_interval
+        if passed:
+            self._last_image = image
+            self._last_time = timestamp
+        return passed
+
+    def get_last_score(self):
+        return self._score
+
+    def reset(self):
+        self._last_image = None
+        self._last_time = None
+        self._score = None
@@ -0,0 +1,208 @@
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+logger = logging.getLogger('spill-log')
+
+# Record header: payload length, payload CRC32, flags, reserved
+# Zero length means the end of segment data (segment files are zero-filled)
+_HEADER = struct.Struct('<IIHH')
+_CONSUMED = 1
+SEGMENT_SUFFIX = '.spill'
+
+
+class _Segment:
+    # Preallocated segment file mapped to memory, records are appended with memcpy
+    def __init__(self, path, size=None):
+        self.path = path
+        with open(path, 'a+b') as file:
+            if size is not None:
+                file.truncate(size)
+            self.size = os.fstat(file.fileno()).st_size
+            self.mmap = mmap.mmap(file.fileno(), self.size)
+        self.read_offset = 0
+        self.write_offset = 0
+
+    def has_room(self, length):
+        return self.write_offset + _HEADER.size + length <= self.size
+
+    def write(self, data):
+        # Payload goes first, so header of partially written record is still zero
+        offset = self.write_offset + _HEADER.size
+        self.mmap[offset:offset + len(data)] = data
+        self.mmap[self.write_offset:offset] = _HEADER.pack(len(data), zlib.crc32(data), 0, 0)
+        self.write_offset = offset + len(data)
+
+    def read_header(self, offset):
+        # (length, crc, flags) of record at offset, None at the end of data
+        if offset + _HEADER.size > self.size:
+            return None
+        length, crc, flags, reserved = _HEADER.unpack_from(self.mmap, offset)
+        if not length or offset + _HEADER.size + length > self.size:
+            return None
+        return length, crc, flags
+
+    def mark_consumed(self, offset):
+        self.mmap[offset + 8:offset + 10] = struct.pack('<H', _CONSUMED)
+
+    def close(self):
+        self.mmap.close()
+
+
+class SpillLog:
+    """
+    SpillLog is on-disk FIFO of byte records, e.g. MLQueue overflow tier. Records are appended to
+    memory-mapped preallocated segment files, so writes and reads are sequential memcpy without
+    syscalls per record, fully read segments are deleted. Every record has CRC32, read records
+    are flagged, so after process crash the log is recovered from its files: unread records are
+    kept and torn tail record is dropped. Recovery scans at most max_bytes
+    :param directory: segment files directory, it's created if it doesn't exist
+    :param segment_size: bytes per segment file, bigger records get their own segments
+    :param max_bytes: disk budget of segment files, appends fail above it, None is unlimited
+    """
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, max_bytes=None):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._segment_size = segment_size
+        self._max_bytes = max_bytes
+        self._segments = collections.deque()
+        self._next_seq = 0
+        self._count = 0
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._recover()
+
+    def _recover(self):
+        names = os.listdir(self._directory)
+        for name in sorted(name for name in names if name.endswith(SEGMENT_SUFFIX)):
+            self._next_seq = max(self._next_seq, int(name[:-len(SEGMENT_SUFFIX)]) + 1)
+            path = os.path.join(self._directory, name)
+            if not os.path.getsize(path):
+                # Crash between segment creation and preallocation
+                os.unlink(path)
+                continue
+            segment = _Segment(path)
+            count = self._scan(segment)
+            if count:
+                self._segments.append(segment)
+                self._count += count
+                self._nbytes += segment.size
+            else:
+                segment.close()
+                os.unlink(segment.path)
+        if self._count:
+            logger.info(f'{self._count} spilled records are recovered from {self._directory}')
+
+    def _scan(self, segment):
+        # Finds the first unread record and the end of valid data, returns unread records count
+        count = 0
+        offset = 0
+        segment.read_offset = None
+        while True:
+            header = segment.read_header(offset)
+            if header is None:
+                break
+            length, crc, flags = header
+            start = offset + _HEADER.size
+            if zlib.crc32(segment.mmap[start:start + length]) != crc:
+                logger.info(f'{segment.path} has torn record at {offset}, the rest is dropped')
+                break
+            if not flags & _CONSUMED:
+                count += 1
+                if segment.read_offset is None:
+                    segment.read_offset = offset
+            offset = start + length
+        # Torn record is overwritten by the next append
+        segment.mmap[offset:min(offset + _HEADER.size, segment.size)] = \
+            bytes(min(_HEADER.size, segment.size - offset))
+        segment.write_offset = offset
+        if segment.read_offset is None:
+            segment.read_offset = offset
+        return count
+
+    def _add_segment(self, length):
+        size = max(self._segment_size, _HEADER.size + length)
+        if self._max_bytes is not None and self._nbytes + size > self._max_bytes:
+            return None
+        path = os.path.join(self._directory, f'{self._next_seq:016d}{SEGMENT_SUFFIX}')
+        self._next_seq += 1
+        segment = _Segment(path, size)
+        self._segments.append(segment)
+        self._nbytes += size
+        return segment
+
+    def append_many(self, records):
+        # Returns number of appended records, the rest don't fit to max_bytes
+        with self._lock:
+            for index, data in enumerate(records):
+                segment = self._segments[-1] if self._segments else None
+                if segment is None or not segment.has_room(len(data)):
+                    segment = self._add_segment(len(data))
+                    if segment is None:
+                        return index
+                segment.write(data)
+                self._count += 1
+            return len(records)
+
+    def append(self, data):
+        return self.append_many([data]) == 1
+
+    def read_many(self, count):
+        # The oldest count records (fewer if there aren't so many), they are removed from the log
+        records = []
+        with self._lock:
+            while self._segments and len(records) < count:
+                segment = self._segments[0]
+                header = segment.read_header(segment.read_offset)
+                if header is None:
+                    if len(self._segments) == 1:
+                        break
+                    self._remove_head()
+                    continue
+                length, crc, flags = header
+                offset = segment.read_offset
+                start = offset + _HEADER.size
+                segment.read_offset = start + length
+                if flags & _CONSUMED:
+                    # It was read before crash
+                    continue
+                records.append(bytes(segment.mmap[start:start + length]))
+                segment.mark_consumed(offset)
+                self._count -= 1
+            if self._segments and not self._count and len(self._segments) == 1:
+                # Everything is read, the last segment isn't kept with stale records
+                self._remove_head()
+        return records
+
+    def read(self):
+        records = self.read_many(1)
+        return records[0] if records else None
+
+    def _remove_head(self):
+        segment = self._segments.popleft()
+        self._nbytes -= segment.size
+        segment.close()
+        os.unlink(segment.path)
+
+    def flush(self):
+        # Written records survive OS crash after flush, process crash doesn't need it
+        with self._lock:
+            for segment in self._segments:
+                segment.mmap.flush()
+
+    def get_nbytes(self):
+        # Disk bytes of segment files
+        return self._nbytes
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+            self._segments.clear()
+
+    def __len__(self):
+        return self._count
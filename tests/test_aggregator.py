@@ -2,7 +2,7 @@ import os
 import unittest
 from random import randint
 
-from aggregator import Aggregator
+from aggregator import Aggregator, AggregatorBank
 
 
 class TestMLQueue(unittest.TestCase):
@@ -59,6 +59,70 @@ class TestMLQueue(unittest.TestCase):
                 self.assertEqual(self._aggregator.check(), None)
                 self.assertEqual(self._aggregator.state, [])
 
+    def test_field_check(self):
+        items = [{'box': None}, {'box': 1}, {'box': 2}, {'box': 3}, {'box': 4}, {'box': 5}]
+        for index, item in enumerate(items):
+            self._aggregator.append(item)
+            if index == 2:
+                self.assertEqual(self._aggregator.check('box', 2), items[1:3])
+                self.assertEqual(self._aggregator.check('box', 3), None)
+        self.assertEqual(self._aggregator.check('box'), items[1:])
+
+        self._aggregator.append({'box': None})
+        self.assertEqual(self._aggregator.check('box'), None)
+        self.assertEqual(self._aggregator.check('box', 1), [{'box': None}])
+        self.assertEqual(self._aggregator.check(), items[2:] + [{'box': None}])
+
+    def test_time_gap(self):
+        aggregator = Aggregator(3, time_gap=60, aggregator_type='time_gap')
+        for item in [1, 1, 1]:
+            aggregator.append(item)
+        self.assertEqual(aggregator.check(), [1, 1, 1])
+        self.assertEqual(aggregator.state, [1, 1, 1])
+
+        aggregator._time_gap = -1
+        self.assertEqual(aggregator.check(), None)
+
+
+class TestAggregatorBank(unittest.TestCase):
+    def test_same_as_aggregator(self):
+        keys = ['camera_1', 'camera_2', 'camera_3']
+        bank = AggregatorBank(5, field_to_check='box', capacity=1)
+        aggregators = {key: Aggregator(5) for key in keys}
+        for step in range(200):
+            results = []
+            for index in range(randint(0, 6)):
+                key = keys[randint(0, len(keys) - 1)]
+                item = {'box': [None, 1, 'label'][randint(0, 2)], 'step': step}
+                results.append((key, item))
+                aggregators[key].append(item)
+            bank.append(results)
+
+            for limit in [None, 3]:
+                expected = {}
+                for key, aggregator in aggregators.items():
+                    batch = aggregator.check('box', limit)
+                    if batch:
+                        expected[key] = batch
+                self.assertEqual(bank.check(limit), expected)
+            for key, aggregator in aggregators.items():
+                self.assertEqual(bank.get_state(key), aggregator.state)
+
+    def test_time_gap_and_reset(self):
+        bank = AggregatorBank(3, time_gap=60, aggregator_type='time_gap')
+        bank.append([('camera_1', 1), ('camera_2', None), ('camera_1', 1), ('camera_1', 1)])
+        self.assertEqual(bank.check(), {'camera_1': [1, 1, 1]})
+        self.assertEqual(bank.check(keys=['camera_2']), {})
+        self.assertEqual(bank.check(limit=1), {'camera_1': [1], 'camera_2': [None]})
+
+        bank._time_gap = -1
+        self.assertEqual(bank.check(), {})
+
+        bank.reset(['camera_1'])
+        self.assertEqual(bank.get_state('camera_1'), [])
+        self.assertEqual(bank.get_state('camera_2'), [None])
+        self.assertEqual(len(bank), 2)
+
 
 if __name__ == '__main__':
     unittest.main()
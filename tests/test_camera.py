@@ -0,0 +1,322 @@
+import io
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+import logging
+import importlib
+import importlib.machinery
+import importlib.util
+
+import numpy as np
+
+
+def load_package():
+    # Camera uses package relative imports, so the repo is imported as pycvutils package
+    if 'pycvutils' not in sys.modules:
+        spec = importlib.machinery.ModuleSpec('pycvutils', None, is_package=True)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        spec.submodule_search_locations = [root]
+        sys.modules['pycvutils'] = importlib.util.module_from_spec(spec)
+    return importlib.import_module('pycvutils.camera')
+
+
+class FakeQueue(list):
+    def put(self, item):
+        self.append(item)
+
+
+def make_async_camera(frames):
+    class PipeCamera(load_package().AsyncCamera):
+        # Python process writes frames instead of ffmpeg
+        def _get_command(self, image_path, **kwargs):
+            script = f'import sys; sys.stdout.buffer.write(bytes(range(60)) * {frames} + b"tail")'
+            return [sys.executable, '-c', script], (4, 5, 3)
+
+    return PipeCamera('rtsp://camera', 'camera', 0)
+
+
+def make_split_camera():
+    class SplitCamera(load_package().Camera):
+        # Python process writes frames to stdout and output pipe instead of ffmpeg
+        def _get_command(self, image_path, **kwargs):
+            fd = int(kwargs['outputs'][0]['pipe'][len('pipe:'):])
+            script = (
+                'import os, sys; sys.stdout.buffer.write(bytes(range(60)) * 2); '
+                f'os.write({fd}, bytes(range(12)) * 4)'
+            )
+            return [sys.executable, '-c', script], (4, 5, 3)
+
+    return SplitCamera('rtsp://camera', 'camera', 0)
+
+
+class FakeWatcher:
+    def wait(self, timeout):
+        return True
+
+
+class TestCamera(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self._camera = load_package().Camera('rtsp://camera', 'camera', 0)
+
+    def test_read_pipe(self):
+        image = np.arange(4 * 5 * 3, dtype=np.uint8).reshape((4, 5, 3))
+        stream = io.BufferedReader(io.BytesIO(image.tobytes() * 2 + b'partial'))
+        queue = FakeQueue()
+
+        self.assertTrue(self._camera._read_pipe(stream, (4, 5, 3), queue))
+        self.assertTrue(self._camera._read_pipe(stream, (4, 5, 3), queue))
+        self.assertFalse(self._camera._read_pipe(stream, (4, 5, 3), queue))
+        self.assertEqual(len(queue), 2)
+        self.assertIs(self._camera.frame, queue[1])
+        self.assertEqual(self._camera.get_frame_counter(), 2)
+        np.testing.assert_array_equal(queue[0].as_np_array(BGR=True), image)
+        np.testing.assert_array_equal(queue[0].as_np_array(), image[:, :, ::-1])
+
+    def test_read_pipe_pool(self):
+        frame_pool = importlib.import_module('pycvutils.frame').FramePool()
+        image = np.arange(4 * 5 * 3, dtype=np.uint8).reshape((4, 5, 3))
+        stream = io.BufferedReader(io.BytesIO(image.tobytes() * 2 + b'partial'))
+        queue = FakeQueue()
+        self._camera._frame_pool = frame_pool
+
+        self.assertTrue(self._camera._read_pipe(stream, (4, 5, 3), queue))
+        buffer = queue[0].as_np_array(BGR=True)
+        queue[0].release()
+        self.assertTrue(self._camera._read_pipe(stream, (4, 5, 3), queue))
+        self.assertIs(queue[1].as_np_array(BGR=True), buffer)
+        np.testing.assert_array_equal(buffer, image)
+        self.assertFalse(self._camera._read_pipe(stream, (4, 5, 3), queue))
+        self.assertEqual(frame_pool.get_stats()['free'], 1)
+
+    def test_gate_pool(self):
+        frame_pool = importlib.import_module('pycvutils.frame').FramePool()
+        image = np.zeros((4, 5, 3), dtype=np.uint8)
+        stream = io.BufferedReader(io.BytesIO(image.tobytes() * 3))
+        queue = FakeQueue()
+        self._camera._frame_pool = frame_pool
+        self._camera._gate = type('Gate', (), {'check': lambda self, frame: not queue})()
+
+        self.assertTrue(self._camera._read_pipe(stream, (4, 5, 3), queue))
+        self.assertTrue(self._camera._read_pipe(stream, (4, 5, 3), queue))
+        gated = self._camera.frame
+        self.assertIsNotNone(gated.as_np_array(BGR=True))
+        # Gated frame is released when it's replaced, so its buffer is reused
+        self.assertTrue(self._camera._read_pipe(stream, (4, 5, 3), queue))
+        self.assertIsNone(gated.as_np_array(BGR=True))
+        self.assertEqual(frame_pool.get_stats()['free'], 1)
+        self.assertEqual(len(queue), 1)
+
+        # Enqueued frame is owned by consumers, camera.frame shares it
+        self._camera._gate = None
+        self._camera._publish(queue[0], FakeQueue())
+        queue[0].release()
+        self.assertIs(self._camera.frame, queue[0])
+        self.assertIsNone(self._camera.frame.as_np_array(BGR=True))
+
+    def test_read_pipe_gray(self):
+        image = np.arange(4 * 5, dtype=np.uint8).reshape((4, 5))
+        stream = io.BufferedReader(io.BytesIO(image.tobytes()))
+        queue = FakeQueue()
+
+        self.assertTrue(self._camera._read_pipe(stream, (4, 5), queue))
+        np.testing.assert_array_equal(queue[0].as_np_array(gray=True), image)
+        self.assertEqual(queue[0].as_np_array(gray=True, size=(10, 8)).shape, (8, 10))
+
+    def test_gate(self):
+        class OddGate:
+            def check(self, frame):
+                return frame.get_time() % 2 == 1
+
+        frame_class = load_package().Frame
+        frames = [
+            frame_class(np.zeros((4, 5, 3), dtype=np.uint8), timestamp=timestamp)
+            for timestamp in range(4)
+        ]
+        queue = FakeQueue()
+        self._camera._gate = OddGate()
+        for frame in frames:
+            self._camera._publish(frame, queue)
+
+        self.assertEqual(queue, [frames[1], frames[3]])
+        self.assertIs(self._camera.frame, frames[3])
+        self.assertEqual(self._camera.get_frame_counter(), 4)
+
+    def test_read_file(self):
+        fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures/chickens.jpg')
+        with open(fixture, 'rb') as file:
+            chickens = file.read()
+        queue = FakeQueue()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'camera.jpg')
+            with open(path, 'wb') as file:
+                file.write(chickens)
+            self._camera._read(path, queue, FakeWatcher())
+            # Unchanged file isn't read and decoded again
+            self._camera._read(path, queue, FakeWatcher())
+            self.assertEqual(len(queue), 1)
+
+            with open(path, 'wb') as file:
+                file.write(chickens + b'\x00')
+            os.utime(path, (100, 100))
+            self._camera._read(path, queue, FakeWatcher())
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue[1].get_time(), 100)
+        self.assertEqual(queue[1].as_np_array().shape, (1080, 1920, 3))
+
+    def test_read_mjpeg(self):
+        class FakePool:
+            def __init__(self):
+                self.images = []
+
+            def submit(self, image, callback, timestamp=None, source=None):
+                self.images.append((image, timestamp))
+                callback(frame_class(image, timestamp=timestamp))
+
+        frame_class = load_package().Frame
+        fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures/chickens.jpg')
+        with open(fixture, 'rb') as file:
+            chickens = file.read()
+        decode_pool = importlib.import_module('pycvutils.decode_pool')
+        splitter = decode_pool.MJPEGSplitter(io.BytesIO(chickens * 2))
+        queue = FakeQueue()
+
+        self.assertTrue(self._camera._read_mjpeg(splitter, queue))
+        self._camera._decode_pool = pool = FakePool()
+        self.assertTrue(self._camera._read_mjpeg(splitter, queue))
+        self.assertFalse(self._camera._read_mjpeg(splitter, queue))
+        self._camera._publish_decoded(None, queue)
+
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue[0].as_np_array().shape, (1080, 1920, 3))
+        self.assertEqual(pool.images, [(chickens, queue[1].get_time())])
+        self.assertEqual(self._camera.get_frame_counter(), 2)
+
+    def test_command(self):
+        command, shape = self._camera._get_command(
+            '/ramdisk/camera.jpg',
+            resolution=(640, 480), fps=5, log_level='error', format='rawvideo', pix_fmt='gray'
+        )
+        self.assertEqual(shape, (480, 640))
+        self.assertEqual(command[-1], 'pipe:1')
+        self.assertIn('gray', command)
+
+        command, shape = self._camera._get_command(
+            None, resolution=(640, 480), fps=5, log_level='error', format='mjpeg', quality=2
+        )
+        self.assertIsNone(shape)
+        self.assertEqual(command[command.index('-f') + 1], 'mjpeg')
+        self.assertEqual(command[-1], 'pipe:1')
+
+    def test_split_command(self):
+        outputs = [
+            {'resolution': (1920, 1080), 'fps': 10, 'format': 'mjpeg', 'pipe': 'pipe:5'},
+            {'resolution': (320, 240), 'fps': 2, 'pix_fmt': 'gray', 'pipe': 'pipe:6'},
+        ]
+        command, shape = self._camera._get_command(
+            None, resolution=(640, 480), fps=5, log_level='error', format='rawvideo',
+            outputs=outputs
+        )
+        self.assertEqual(shape, (480, 640, 3))
+        self.assertEqual(command.count('-i'), 1)
+        graph = command[command.index('-filter_complex') + 1]
+        self.assertTrue(graph.startswith('[0:v]split=3[s0][s1][s2];'))
+        self.assertIn('[s1]fps=fps=10,scale=1920x1080[o1]', graph)
+        self.assertEqual([command[index + 1] for index, option in enumerate(command)
+                          if option == '-map'], ['[o0]', '[o1]', '[o2]'])
+        self.assertEqual(command[-1], 'pipe:6')
+        self.assertEqual(command.count('-threads'), 3)
+        self.assertGreater(command.index('-threads'), command.index('-map'))
+        self.assertIn('pipe:1', command)
+        self.assertIn('gray', command)
+
+        with self.assertRaises(ValueError):
+            self._camera._get_command(
+                '/ramdisk/camera.jpg', resolution=(640, 480), fps=5, log_level='error',
+                format='image2', outputs=outputs
+            )
+
+    def test_split_outputs(self):
+        camera = make_split_camera()
+        queue = FakeQueue()
+        output_queue = FakeQueue()
+        camera._start_camera_loop(
+            queue=queue, format='rawvideo', fps=5, loop_delay=0, restart=False,
+            outputs=[{'resolution': (2, 2), 'fps': 10, 'queue': output_queue}]
+        )
+        deadline = time.monotonic() + 10
+        while len(output_queue) < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(len(output_queue), 4)
+        np.testing.assert_array_equal(
+            output_queue[3].as_np_array(BGR=True).ravel(), np.arange(12, dtype=np.uint8)
+        )
+        # Frames of the same moment have the same timestamp
+        self.assertEqual(queue[1].get_time(), output_queue[2].get_time())
+        self.assertAlmostEqual(output_queue[1].get_time() - output_queue[0].get_time(), 0.1, 5)
+
+    def test_read_output_error(self):
+        class FailingQueue(FakeQueue):
+            def put(self, item):
+                super().put(item)
+                if len(self) == 1:
+                    raise ValueError('full')
+
+        queue = FailingQueue()
+        stream = io.BufferedReader(io.BytesIO(bytes(range(12)) * 3))
+        output = {'resolution': (2, 2), 'format': 'rawvideo', 'shape': (2, 2, 3), 'queue': queue}
+        self._camera._read_output(stream, output, time.time)
+        # Reader keeps reading after queue failure
+        self.assertEqual(len(queue), 3)
+        self.assertTrue(stream.closed)
+
+    def test_async_camera(self):
+        camera = make_async_camera(2)
+        queue = FakeQueue()
+
+        async def run():
+            await camera.start(
+                queue=queue, format='rawvideo', fps=5, loop_delay=0, restart=False
+            )
+        asyncio.run(run())
+
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(camera._process.returncode, 0)
+        self.assertIsNone(camera.frame)
+        np.testing.assert_array_equal(
+            queue[1].as_np_array(BGR=True).ravel(), np.arange(60, dtype=np.uint8)
+        )
+        # Pixels are writable, e.g. for drawing
+        queue[1].as_np_array(BGR=True)[0, 0] = 0
+
+    def test_async_camera_restart(self):
+        camera = make_async_camera(1)
+        queue = FakeQueue()
+
+        async def run():
+            task = camera.start(
+                queue=queue, format='rawvideo', fps=5, loop_delay=0, restart=True,
+                restart_delay=0
+            )
+            while len(queue) < 3:
+                await asyncio.sleep(0.01)
+            camera.stop()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        asyncio.run(asyncio.wait_for(run(), 10))
+
+        self.assertTrue(camera._task.cancelled())
+        with self.assertRaises(ValueError):
+            camera.start(format='mjpeg')
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+import logging
+import threading
+import time
+
+from camera_manager import CameraManager
+
+
+class FakeCamera:
+    def __init__(self, name, frames, ignored_stops=0):
+        self._name = name
+        self._frames = frames
+        self._ignored_stops = ignored_stops
+        self._frame_counter = 0
+        self._last_frame_time = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self.starts = 0
+        self.running = 0
+        self.max_running = 0
+
+    def _start_camera_loop(self, **kwargs):
+        with self._lock:
+            self.starts += 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        self._stopped.clear()
+        for index in range(self._frames):
+            if self._stopped.wait(0.01):
+                break
+            self._frame_counter += 1
+            self._last_frame_time = time.monotonic()
+        # Stream hangs without frames until it's killed
+        self._stopped.wait()
+        with self._lock:
+            self.running -= 1
+
+    def start(self, executor=None, **kwargs):
+        return executor.submit(self._start_camera_loop, **kwargs)
+
+    def stop(self):
+        # Killing of ffmpeg process group can fail
+        if self._ignored_stops:
+            self._ignored_stops -= 1
+        else:
+            self._stopped.set()
+
+    def get_frame_counter(self):
+        return self._frame_counter
+
+    def get_last_frame_time(self):
+        return self._last_frame_time
+
+
+class TestCameraManager(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self._manager = CameraManager(
+            2, stall_timeout=0.2, check_interval=0.02, backoff_base=0.1, backoff_max=0.1
+        )
+
+    def test_health_and_stall_restart(self):
+        streaming = FakeCamera('streaming', 10 ** 6)
+        stalling = FakeCamera('stalling', 5)
+        self._manager.add(streaming, queue=None)
+        self._manager.add(stalling, queue=None)
+        self._manager.start()
+        time.sleep(0.3)
+
+        health = self._manager.get_health()
+        self.assertEqual(health['streaming']['status'], 'running')
+        self.assertGreater(health['streaming']['fps'], 10)
+        self.assertEqual(health['streaming']['failures'], 0)
+
+        time.sleep(0.7)
+        self.assertEqual(streaming.starts, 1)
+        self.assertGreater(stalling.starts, 1)
+        self.assertLessEqual(threading.active_count(), 4)
+
+    def test_failed_stop(self):
+        camera = FakeCamera('camera', 5, ignored_stops=3)
+        self._manager.add(camera, queue=None)
+        self._manager.start()
+        time.sleep(1)
+
+        self.assertGreater(camera.starts, 1)
+        self.assertEqual(camera.max_running, 1)
+
+    def test_too_many_cameras(self):
+        self._manager.add(FakeCamera('camera_1', 1), queue=None)
+        self._manager.add(FakeCamera('camera_2', 1), queue=None)
+        with self.assertRaises(ValueError):
+            self._manager.add(FakeCamera('camera_3', 1), queue=None)
+
+    def tearDown(self):
+        self._manager.stop()
+        logging.disable(logging.NOTSET)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import io
+import os
+import threading
+import unittest
+import logging
+import multiprocessing
+import importlib
+
+import numpy as np
+
+from test_camera import load_package
+
+
+class TestDecodePool(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        load_package()
+        self._module = importlib.import_module('pycvutils.decode_pool')
+        # Test package is loaded from path, so only forked workers can import it
+        self._mp_context = multiprocessing.get_context('fork')
+        fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures/chickens.jpg')
+        with open(fixture, 'rb') as file:
+            self._chickens = file.read()
+
+    def test_splitter(self):
+        stream = io.BytesIO(self._chickens * 3 + self._chickens[:100])
+        # Small chunks split EOI markers too
+        splitter = self._module.MJPEGSplitter(stream, chunk_size=1001)
+
+        for index in range(3):
+            self.assertEqual(splitter.read(), self._chickens)
+        self.assertIsNone(splitter.read())
+
+    def test_decode(self):
+        pool = self._module.DecodePool(workers=2, size=(320, 180), mp_context=self._mp_context)
+        frames = []
+        done = threading.Event()
+
+        def callback(frame):
+            frames.append(frame)
+            if len(frames) == 3:
+                done.set()
+
+        try:
+            self.assertTrue(pool.submit(self._chickens, callback, timestamp=1.5))
+            self.assertTrue(pool.submit(self._chickens, callback, timestamp=2.5))
+            self.assertTrue(pool.submit(b'not an image', callback, timestamp=3.5))
+            self.assertTrue(done.wait(30))
+        finally:
+            pool.close()
+
+        decoded = sorted((frame for frame in frames if frame), key=lambda frame: frame.get_time())
+        self.assertEqual(len(decoded), 2)
+        self.assertEqual([frame.get_time() for frame in decoded], [1.5, 2.5])
+        self.assertEqual(decoded[0].as_np_array(BGR=True).shape, (180, 320, 3))
+        self.assertEqual(pool.get_pending(), 0)
+
+    def test_max_pending(self):
+        pool = self._module.DecodePool(workers=1, max_pending=1, mp_context=self._mp_context)
+        done = threading.Event()
+        try:
+            self.assertTrue(pool.submit(self._chickens, lambda frame: done.set()))
+            self.assertFalse(pool.submit(self._chickens, lambda frame: None))
+            self.assertTrue(done.wait(30))
+        finally:
+            pool.close()
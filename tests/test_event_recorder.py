@@ -0,0 +1,104 @@
+import os
+import sys
+import tempfile
+import unittest
+
+from frame import Frame
+from event_recorder import EventRecorder
+
+
+def make_jpeg(index):
+    # Markers are enough for recorder, it doesn't decode frames
+    return b'\xff\xd8' + bytes([index]) + b'\xff\xd9'
+
+
+class FileRecorder(EventRecorder):
+    # Clip is copied from stdin as it is instead of ffmpeg muxing
+    def _get_command(self, path):
+        script = 'import shutil, sys; shutil.copyfileobj(sys.stdin.buffer, open(sys.argv[1], "wb"))'
+        return [sys.executable, '-c', script, path]
+
+
+class TestEventRecorder(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._directory.name, 'clip.mp4')
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def _put(self, recorder, index, timestamp):
+        recorder.put(Frame(make_jpeg(index), timestamp=timestamp))
+
+    def _read_clip(self):
+        with open(self._path, 'rb') as file:
+            return file.read()
+
+    def test_ring(self):
+        recorder = FileRecorder(pre_seconds=2, fps=2)
+        for index in range(10):
+            self._put(recorder, index, index * 0.5)
+        # 2.5 .. 4.5
+        self.assertEqual(len(recorder), 5)
+        self.assertEqual(recorder.get_nbytes(), 5 * 5)
+        self.assertFalse(recorder.is_recording())
+
+        recorder = FileRecorder(pre_seconds=2, fps=2, max_bytes=12)
+        for index in range(10):
+            self._put(recorder, index, index * 0.5)
+        self.assertEqual(len(recorder), 2)
+
+    def test_clip(self):
+        recorder = FileRecorder(pre_seconds=1, post_seconds=1, fps=2)
+        for index in range(4):
+            self._put(recorder, index, index * 0.5)
+        self.assertTrue(recorder.trigger(self._path, event_time=1.5))
+        self.assertTrue(recorder.is_recording())
+        # 3.0 frame is missed, so 2.5 one is repeated
+        self._put(recorder, 4, 2.0)
+        self._put(recorder, 5, 2.5)
+        # Clip is extended till 4.0
+        self.assertFalse(recorder.trigger(self._path, event_time=3.0))
+        self._put(recorder, 6, 3.5)
+        clip = recorder._clip
+        self._put(recorder, 7, 4.5)
+        self.assertFalse(recorder.is_recording())
+        clip.thread.join()
+
+        expected = [1, 2, 3, 4, 5, 5, 6]
+        self.assertEqual(self._read_clip(), b''.join(make_jpeg(index) for index in expected))
+        self.assertEqual(clip.written, len(expected))
+
+    def test_close(self):
+        recorder = FileRecorder(pre_seconds=1, post_seconds=10, fps=4)
+        self._put(recorder, 0, 0.0)
+        self._put(recorder, 1, 0.5)
+        self.assertTrue(recorder.trigger(self._path, event_time=0.5))
+        recorder.close()
+        self.assertFalse(recorder.is_recording())
+
+        # Frames are repeated to the clip frame rate
+        expected = [0, 0, 1]
+        self.assertEqual(self._read_clip(), b''.join(make_jpeg(index) for index in expected))
+
+    def test_timeout(self):
+        recorder = FileRecorder(pre_seconds=0, post_seconds=0.01, fps=2)
+        self._put(recorder, 0, 0.0)
+        self.assertTrue(recorder.trigger(self._path, event_time=0.0))
+        clip = recorder._clip
+        # Camera is down, clip is finished after timeout
+        clip.thread.join(5)
+        self.assertFalse(recorder.is_recording())
+        self._put(recorder, 1, 0.005)
+        self.assertIsNone(recorder._clip)
+        self.assertEqual(self._read_clip(), make_jpeg(0))
+
+    def test_command(self):
+        command = EventRecorder(fps=5)._get_command('clip.mp4')
+        self.assertEqual(command[command.index('-framerate') + 1], '5')
+        self.assertEqual(command[command.index('-c:v') + 1], 'copy')
+        self.assertEqual(command[-1], 'clip.mp4')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import logging
+
+from file_watcher import InotifyWatcher, PollingWatcher, get_file_watcher
+
+
+def write_later(path, data, delay=0.05):
+    def write():
+        with open(path, 'wb') as file:
+            file.write(data)
+
+    timer = threading.Timer(delay, write)
+    timer.start()
+    return timer
+
+
+class TestFileWatcher(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, 'camera.jpg')
+        with open(self._path, 'wb') as file:
+            file.write(b'old')
+
+    def _check_watcher(self, watcher):
+        try:
+            # Existing file isn't a change
+            self.assertFalse(watcher.wait(0.01))
+
+            write_later(os.path.join(self._directory, 'other.jpg'), b'other').join()
+            self.assertFalse(watcher.wait(0.05))
+
+            timer = write_later(self._path, b'new frame')
+            self.assertTrue(watcher.wait(2))
+            timer.join()
+            self.assertFalse(watcher.wait(0.05))
+        finally:
+            watcher.close()
+
+    def test_inotify(self):
+        try:
+            watcher = InotifyWatcher(self._path)
+        except (OSError, AttributeError) as ex:
+            self.skipTest('inotify is not available')
+        self._check_watcher(watcher)
+
+    def test_polling(self):
+        self._check_watcher(PollingWatcher(self._path, 0.005))
+
+    def test_fallback(self):
+        watcher = get_file_watcher(os.path.join(self._directory, 'missing/camera.jpg'), 0.01)
+        self.assertIsInstance(watcher, PollingWatcher)
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+        logging.disable(logging.NOTSET)
+
+
+if __name__ == '__main__':
+    unittest.main()
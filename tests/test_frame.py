@@ -1,12 +1,16 @@
 import sys
 import os
 import unittest
+import cv2
 import numpy as np
 import datetime
 import pickle
 from time import sleep
 
-from frame import Frame
+from frame import (
+    Frame, FrameBatch, FramePool, FrameSerializer, OpenCVDecoder, TurboJPEGDecoder,
+    get_jpeg_size, release_frames, turbojpeg
+)
 
 
 class FrameTest(unittest.TestCase):
@@ -59,7 +63,8 @@ class FrameTest(unittest.TestCase):
         self.assertFalse(self._pickle_frame._corrupted)
 
     def test_image_to_np_array(self):
-        np_img_rgb, np_img_bgr = self._frame._image_to_np_array(self._chickens)
+        np_img_bgr = self._frame._image_to_np_array(self._chickens)
+        np_img_rgb = self._frame._np_image
 
         self.assertIsInstance(np_img_rgb, np.ndarray)
         self.assertIsInstance(np_img_bgr, np.ndarray)
@@ -91,3 +96,330 @@ class FrameTest(unittest.TestCase):
         self.assertIsInstance(img_bgr, bytes)
         self.assertIsInstance(pickle_img_rgb, bytes)
         self.assertIsInstance(pickle_img_bgr, bytes)
+
+
+class LazyFrameTest(unittest.TestCase):
+    def setUp(self):
+        dirname = os.path.dirname(__file__)
+        with open(os.path.join(dirname, 'fixtures/chickens.jpg'), 'rb') as file:
+            self._chickens = file.read()
+
+    def test_lazy_decode(self):
+        frame = Frame(self._chickens)
+        self.assertIsNone(frame._image)
+        self.assertFalse(frame.is_corrupted())
+        self.assertIsNone(frame._image)
+
+        self.assertIsInstance(frame.as_np_array(), np.ndarray)
+        self.assertIsNotNone(frame._image)
+        self.assertTrue(frame.as_np_array(BGR=True).flags.writeable)
+
+    def test_corrupted(self):
+        self.assertTrue(Frame(self._chickens[:-100]).is_corrupted())
+        self.assertTrue(Frame(b'not an image').is_corrupted())
+
+        padded = Frame(self._chickens + b'\x00\x00')
+        self.assertFalse(padded.is_corrupted())
+        self.assertEqual(padded.as_np_array().shape, (1080, 1920, 3))
+
+        # Markers are fine, body isn't
+        damaged = self._chickens[:2] + bytes(1000) + self._chickens[-2:]
+        self.assertFalse(Frame(damaged).is_corrupted())
+        self.assertTrue(Frame(damaged).is_corrupted(decode=True))
+
+    def test_cached_conversions(self):
+        frame = Frame(self._chickens)
+        gray = frame.as_np_array(gray=True)
+        self.assertEqual(gray.shape, (1080, 1920))
+        self.assertIs(frame.as_np_array(gray=True), gray)
+
+        small = frame.as_np_array(size=(320, 180))
+        self.assertEqual(small.shape, (180, 320, 3))
+        self.assertIs(frame.as_np_array(size=(320, 180)), small)
+        # List size is the same variant
+        self.assertIs(frame.as_np_array(size=[320, 180]), small)
+        numpy_frame = Frame(np.zeros((20, 40, 3), dtype=np.uint8))
+        self.assertEqual(numpy_frame.as_np_array(size=[10, 5]).shape, (5, 10, 3))
+
+    def test_single_storage(self):
+        frame = Frame(self._chickens)
+        self.assertFalse(hasattr(frame, '__dict__'))
+        bgr = frame.as_np_array(BGR=True)
+        self.assertTrue(bgr.flags['C_CONTIGUOUS'])
+        self.assertIs(frame.as_np_array(BGR=True), bgr)
+        bgr_copy = bgr.copy()
+
+        # Given out order becomes the stored one, so changes of default RGB pixels are kept
+        rgb = frame.as_np_array()
+        self.assertTrue(rgb.flags['C_CONTIGUOUS'])
+        self.assertIs(frame.as_np_array(), rgb)
+        np.testing.assert_array_equal(rgb, bgr_copy[:, :, ::-1])
+        rgb[0, 0] = (1, 2, 3)
+        self.assertEqual(list(frame.as_np_array(BGR=True)[0, 0]), [3, 2, 1])
+        roi = frame.get_roi(0, 0, 10, 10)
+        roi[1, 1] = (4, 5, 6)
+        self.assertEqual(list(frame.as_np_array(BGR=True)[1, 1]), [6, 5, 4])
+        np_image = cv2.imdecode(np.frombuffer(frame.as_binary(), np.uint8), cv2.IMREAD_COLOR)
+        self.assertLess(abs(int(np_image[0, 0, 0]) - 3), 30)
+
+        out = np.empty_like(rgb)
+        self.assertIs(frame.as_np_array(out=out), out)
+        self.assertEqual(list(out[0, 0]), [1, 2, 3])
+        self.assertIs(frame.as_np_array(BGR=True, out=out), out)
+        self.assertEqual(list(out[0, 0]), [3, 2, 1])
+
+    def test_swap_in_place(self):
+        pool = FramePool()
+        image = pool.acquire((4, 5, 3))
+        image[:] = np.arange(60, dtype=np.uint8).reshape(4, 5, 3)
+        frame = Frame(image, BGR=True, pool=pool)
+        # Pixels aren't given out before, so pool buffer is swapped in place
+        self.assertIs(frame.as_np_array(), image)
+        self.assertEqual(list(image[0, 0]), [2, 1, 0])
+        bgr = frame.as_np_array(BGR=True)
+        self.assertIsNot(bgr, image)
+        self.assertEqual(list(bgr[0, 0]), [0, 1, 2])
+        frame.release()
+        self.assertEqual(pool.get_stats()['released'], 0)
+
+    def test_nbytes(self):
+        frame = Frame(self._chickens)
+        self.assertEqual(frame.nbytes, len(self._chickens))
+        frame.as_np_array(size=(320, 180))
+        self.assertEqual(frame.nbytes, len(self._chickens) + 320 * 180 * 3)
+
+        image = np.zeros((10, 20, 3), dtype=np.uint8)
+        self.assertEqual(Frame(image).nbytes, 600)
+        self.assertEqual(Frame(image, BGR=True).nbytes, 600)
+
+    def test_get_roi(self):
+        image = np.arange(10 * 20 * 3, dtype=np.uint8).reshape((10, 20, 3))
+        frame = Frame(image, BGR=True)
+        roi = frame.get_roi(15, -2, 10, 5, BGR=True)
+
+        self.assertEqual(roi.shape, (3, 5, 3))
+        self.assertTrue(np.shares_memory(roi, image))
+        roi[:] = 0
+        self.assertFalse(image[:3, 15:].any())
+        self.assertIsNone(Frame(b'not an image').get_roi(0, 0, 1, 1))
+
+    def test_resize_out(self):
+        frame = Frame(self._chickens)
+        out = np.empty((180, 320, 3), np.uint8)
+
+        self.assertIs(frame.resize((320, 180), out=out), out)
+        np.testing.assert_array_equal(out, frame.as_np_array(size=(320, 180)))
+        self.assertIs(frame.resize((320, 180), BGR=True, out=out), out)
+        np.testing.assert_array_equal(out, frame.as_np_array(size=(320, 180))[:, :, ::-1])
+        self.assertIsNone(frame._image)
+
+        gray = Frame(np.full((36, 64), 7, np.uint8), single_channel=True)
+        self.assertEqual(gray.resize((32, 18)).shape, (18, 32))
+        self.assertIs(gray.resize((32, 18), out=out[:18, :32]).base, out)
+        self.assertTrue((out[:18, :32] == 7).all())
+
+    def test_letterbox(self):
+        frame = Frame(np.full((100, 200, 3), 9, np.uint8), BGR=True)
+        out = np.full((64, 64, 3), 1, np.uint8)
+
+        result, scale, offset = frame.letterbox((64, 64), out=out, fill=114)
+        self.assertIs(result, out)
+        self.assertEqual((scale, offset), (0.32, (0, 16)))
+        self.assertTrue((out[:16] == 114).all())
+        self.assertTrue((out[16:48] == 9).all())
+        self.assertTrue((out[48:] == 114).all())
+
+        result, scale, offset = Frame(self._chickens).letterbox((100, 100))
+        self.assertEqual(result.shape, (100, 100, 3))
+        self.assertEqual(offset, (0, 22))
+        self.assertIsNone(Frame(b'not an image').letterbox((10, 10)))
+
+    def test_copy(self):
+        frame = Frame(self._chickens, timestamp=5)
+        copy = frame.copy()
+        self.assertEqual(copy.get_time(), 5)
+        self.assertIs(copy.as_binary(), self._chickens)
+        self.assertIsNone(copy._image)
+
+        pixels = frame.as_np_array(BGR=True)
+        copy = frame.copy()
+        self.assertIsNone(copy._binary)
+        self.assertFalse(np.shares_memory(copy._image, frame._image))
+        np.testing.assert_array_equal(copy.as_np_array(BGR=True), pixels)
+
+        gray = Frame(np.zeros((4, 5), np.uint8), single_channel=True, timestamp=1).copy()
+        self.assertEqual((gray.as_np_array(gray=True).shape, gray.get_time()), ((4, 5), 1))
+
+    def test_serialize(self):
+        frame = Frame.deserialize(Frame(self._chickens, BGR=True, timestamp=5.5).serialize())
+        self.assertEqual(frame.get_time(), 5.5)
+        self.assertIs(frame.as_binary(BGR=True), frame._binary)
+        self.assertEqual(frame._binary, self._chickens)
+
+        image = np.zeros((8, 8, 3), np.uint8)
+        image[:, :, 2] = 255
+        frame = Frame.deserialize(Frame(image, BGR=True).serialize())
+        self.assertGreater(frame.as_np_array(BGR=True)[0, 0, 2], 240)
+
+        serializer = FrameSerializer()
+        self.assertEqual(serializer.loads(serializer.dumps({'item': 1})), {'item': 1})
+        frame = serializer.loads(serializer.dumps(Frame(self._chickens, timestamp=1)))
+        self.assertEqual((frame.get_time(), frame._binary), (1, self._chickens))
+
+    def test_as_binary_reuses_original(self):
+        frame = Frame(self._chickens)
+        self.assertIs(frame.as_binary(), self._chickens)
+        self.assertIsNot(frame.as_binary(BGR=True), self._chickens)
+        self.assertIs(Frame(self._chickens, BGR=True).as_binary(BGR=True), self._chickens)
+
+        frame.as_np_array(size=(320, 180))
+        self.assertIs(frame.as_binary(), self._chickens)
+        frame.as_np_array(BGR=True)[:10] = 0
+        self.assertIsNot(frame.as_binary(), self._chickens)
+
+    def test_reduced_decode(self):
+        self.assertEqual(get_jpeg_size(self._chickens), (1920, 1080))
+        self.assertEqual(get_jpeg_size(b'not an image'), None)
+
+        frame = Frame(self._chickens)
+        small = frame.as_np_array(size=(480, 270))
+        self.assertEqual(small.shape, (270, 480, 3))
+        self.assertEqual(frame.as_np_array(gray=True, size=(200, 100)).shape, (100, 200))
+        self.assertIsNone(frame._image)
+
+        full_small = Frame(frame.as_np_array()).as_np_array(size=(480, 270))
+        self.assertLess(np.abs(small.astype(int) - full_small).mean(), 5)
+
+        bgr_small = Frame(self._chickens).as_np_array(BGR=True, size=(480, 270))
+        self.assertTrue(bgr_small.flags['C_CONTIGUOUS'])
+        np.testing.assert_array_equal(bgr_small, small[:, :, ::-1])
+
+    def test_gray_call_order(self):
+        decoded_first = Frame(self._chickens)
+        decoded_first.as_np_array()
+        gray_first = Frame(self._chickens)
+
+        np.testing.assert_array_equal(
+            decoded_first.as_np_array(gray=True), gray_first.as_np_array(gray=True)
+        )
+        gray = gray_first.as_np_array(gray=True)
+        self.assertIs(gray_first.as_np_array(BGR=True, gray=True), gray)
+
+        bgr_binary = Frame(self._chickens, BGR=True)
+        decoded = Frame(bgr_binary.as_np_array())
+        self.assertLess(
+            np.abs(
+                bgr_binary.as_np_array(gray=True).astype(int) - decoded.as_np_array(gray=True)
+            ).mean(),
+            1
+        )
+
+    @unittest.skipIf(turbojpeg is None, 'PyTurboJPEG is not installed')
+    def test_turbojpeg_decoder(self):
+        try:
+            decoder = TurboJPEGDecoder()
+        except Exception as ex:
+            self.skipTest('libjpeg-turbo is not found')
+        self.assertEqual(decoder.decode(self._chickens).shape, (1080, 1920, 3))
+        self.assertEqual(decoder.decode(self._chickens, 4).shape, (270, 480, 3))
+        self.assertEqual(decoder.decode(self._chickens, 2, gray=True).shape, (540, 960))
+
+    def test_decoder(self):
+        Frame.decoder = OpenCVDecoder()
+        try:
+            frame = Frame(self._chickens)
+            self.assertEqual(frame.as_np_array().shape, (1080, 1920, 3))
+            self.assertIs(Frame._get_decoder(self._chickens), Frame.decoder)
+            self.assertIs(Frame._get_decoder(b'not an image'), Frame._opencv_decoder)
+        finally:
+            Frame.decoder = None
+
+
+class FrameBatchTest(unittest.TestCase):
+    def setUp(self):
+        dirname = os.path.dirname(__file__)
+        with open(os.path.join(dirname, 'fixtures/chickens.jpg'), 'rb') as file:
+            self._chickens = file.read()
+
+    def test_uint8_tensor(self):
+        frame = Frame(self._chickens)
+        batch = FrameBatch([self._chickens, frame, b'not an image'], (320, 180))
+        tensor = batch.as_tensor()
+
+        self.assertEqual(tensor.shape, (3, 180, 320, 3))
+        self.assertEqual(tensor.dtype, np.uint8)
+        self.assertTrue(tensor.flags['C_CONTIGUOUS'])
+        self.assertEqual(batch.get_corrupted(), [2])
+        np.testing.assert_array_equal(tensor[0], frame.as_np_array(size=(320, 180)))
+        np.testing.assert_array_equal(tensor[1], tensor[0])
+        self.assertFalse(tensor[2].any())
+
+        bgr_tensor = FrameBatch([frame], (320, 180), BGR=True).as_tensor()
+        np.testing.assert_array_equal(bgr_tensor[0], tensor[0][:, :, ::-1])
+
+    def test_reduced_decode(self):
+        frame = Frame(self._chickens)
+        FrameBatch([frame], (224, 224)).as_tensor()
+        self.assertIsNone(frame._image)
+
+    def test_float_tensor(self):
+        frame = Frame(self._chickens)
+        tensor = FrameBatch([frame], (64, 36), dtype=np.float32, mean=0.5, std=0.25).as_tensor()
+        expected = (frame.as_np_array(size=(64, 36)) / 255 - 0.5) / 0.25
+
+        self.assertEqual(tensor.dtype, np.float32)
+        np.testing.assert_allclose(tensor[0], expected, atol=1e-5)
+
+
+class FramePoolTest(unittest.TestCase):
+    def setUp(self):
+        dirname = os.path.dirname(__file__)
+        with open(os.path.join(dirname, 'fixtures/chickens.jpg'), 'rb') as file:
+            self._chickens = file.read()
+        self._decoder = Frame.decoder
+
+    def tearDown(self):
+        Frame.decoder = self._decoder
+
+    def test_acquire_release(self):
+        pool = FramePool(max_buffers=1)
+        buffer = pool.acquire((4, 5, 3))
+        frame = Frame(buffer, BGR=True, pool=pool)
+        frame.as_np_array(gray=True)
+        frame.release()
+        frame.release()
+
+        self.assertIsNone(frame.as_np_array())
+        self.assertIs(pool.acquire((4, 5, 3)), buffer)
+        self.assertIsNot(pool.acquire((4, 5)), buffer)
+        pool.release(np.empty((4, 5, 3), np.uint8))
+        pool.release(np.empty((4, 5, 3), np.uint8))
+        self.assertEqual(
+            pool.get_stats(),
+            {'hits': 1, 'misses': 2, 'released': 2, 'discarded': 1, 'free': 1, 'free_bytes': 60}
+        )
+
+    def test_decode_to_pool(self):
+        class OutDecoder(OpenCVDecoder):
+            supports_out = True
+
+            def decode(self, image, scale=1, gray=False, out=None):
+                np_image = super().decode(image, scale, gray)
+                if out is None:
+                    return np_image
+                out[:] = np_image
+                return out
+
+        Frame.decoder = OutDecoder()
+        pool = FramePool()
+        buffer = pool.acquire((1080, 1920, 3))
+        pool.release(buffer)
+        frame = Frame(self._chickens, pool=pool)
+
+        self.assertTrue(np.shares_memory(frame.as_np_array(BGR=True), buffer))
+        release_frames([frame, 'not a frame'])
+        self.assertEqual(frame.as_np_array().shape, (1080, 1920, 3))
+        self.assertEqual(pool.get_stats()['hits'], 2)
+        # Decoder without out support allocates as before
+        Frame.decoder = OpenCVDecoder()
+        self.assertFalse(np.shares_memory(Frame(self._chickens, pool=pool).as_np_array(), buffer))
@@ -0,0 +1,108 @@
+import os
+import sys
+import unittest
+import logging
+import tempfile
+import subprocess
+
+import numpy as np
+
+from test_camera import load_package
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONSUMER = '''
+import sys
+sys.path.insert(0, {tests!r})
+from test_camera import load_package
+load_package()
+from pycvutils.frame_ring import FrameRing
+ring = FrameRing('ring', 4, (4, 5, 3), create=False, directory={directory!r})
+frame = ring.get()
+print(ring.get_seq(), int(frame.as_np_array(BGR=True)[0, 0, 0]))
+ring.close()
+'''
+
+
+class TestFrameRing(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        load_package()
+        from pycvutils.frame_ring import FrameRing
+        from pycvutils.frame import Frame
+        self._frame_class = Frame
+        self._directory = tempfile.mkdtemp()
+        self._ring = FrameRing('ring', 4, (4, 5, 3), directory=self._directory)
+        self._ring_class = FrameRing
+
+    def tearDown(self):
+        self._ring.close()
+        if os.path.exists(os.path.join(self._directory, 'ring')):
+            self._ring.unlink()
+        os.rmdir(self._directory)
+
+    def _make_frame(self, value):
+        return self._frame_class(np.full((4, 5, 3), value, dtype=np.uint8), BGR=True)
+
+    def test_put_get(self):
+        self.assertIsNone(self._ring.get())
+        self.assertEqual(self._ring.put(self._make_frame(7)), 1)
+        frame = self._ring.get()
+
+        self.assertEqual(frame.get_seq(), 1)
+        self.assertEqual(frame.as_np_array(BGR=True)[0, 0, 0], 7)
+        self.assertEqual(len(self._ring), 1)
+
+    def test_put_rgb(self):
+        image = np.zeros((4, 5, 3), dtype=np.uint8)
+        image[:, :, 0] = 255
+        self._ring.put(self._frame_class(image))
+
+        self.assertEqual(list(self._ring.get().as_np_array(BGR=True)[0, 0]), [0, 0, 255])
+
+    def test_wrong_shape(self):
+        frame = self._frame_class(np.zeros((2, 2, 3), dtype=np.uint8))
+
+        self.assertIsNone(self._ring.put(frame))
+        self.assertEqual(self._ring.get_seq(), 0)
+
+    def test_is_overwritten(self):
+        self._ring.put(self._make_frame(1))
+        frame = self._ring.get(1)
+        for value in range(2, 6):
+            self._ring.put(self._make_frame(value))
+
+        self.assertTrue(frame.is_overwritten())
+        self.assertIsNone(self._ring.get(1))
+        self.assertEqual(self._ring.get(2).as_np_array(BGR=True)[0, 0, 0], 2)
+        self.assertEqual(len(self._ring), 4)
+
+    def test_gray(self):
+        ring = self._ring_class('gray', 2, (4, 5), directory=self._directory)
+        ring.put(self._frame_class(np.full((4, 5), 9, dtype=np.uint8), single_channel=True))
+        image = ring.get().as_np_array(gray=True)
+        ring.close()
+        ring.unlink()
+
+        self.assertEqual(image.shape, (4, 5))
+        self.assertEqual(image[0, 0], 9)
+
+    def test_attach_from_other_process(self):
+        self._ring.put(self._make_frame(3))
+        self._ring.put(self._make_frame(5))
+        script = CONSUMER.format(tests=os.path.join(ROOT, 'tests'), directory=self._directory)
+        output = subprocess.run(
+            [sys.executable, '-c', script], stdout=subprocess.PIPE, check=True
+        ).stdout
+
+        self.assertEqual(output.split(), [b'2', b'5'])
+
+    def test_close_unlink(self):
+        self._ring.put(self._make_frame(1))
+        self._ring.close()
+        self._ring.unlink()
+
+        self.assertFalse(os.path.exists(os.path.join(self._directory, 'ring')))
+        with self.assertRaises(FileNotFoundError):
+            self._ring_class('ring', 4, (4, 5, 3), create=False, directory=self._directory)
+        self._ring = self._ring_class('ring', 4, (4, 5, 3), directory=self._directory)
@@ -0,0 +1,64 @@
+import unittest
+import logging
+import urllib.request
+
+from metrics import Metrics
+from ml_queue import MLQueue
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self._metrics = Metrics()
+
+    def test_render(self):
+        self._metrics.inc('frames_read', camera='cam_1')
+        self._metrics.inc('frames_read', 2, camera='cam_1')
+        self._metrics.set('queue_depth', 10, queue='q')
+        self._metrics.observe('decode_ms', 3)
+        self._metrics.observe('decode_ms', 3000)
+
+        self.assertEqual(self._metrics.get('frames_read', camera='cam_1'), 3)
+        self.assertEqual(self._metrics.get('decode_ms'), 2)
+        text = self._metrics.render()
+        self.assertIn('# TYPE pycv_frames_read_total counter', text)
+        self.assertIn('pycv_frames_read_total{camera="cam_1"} 3', text)
+        self.assertIn('pycv_queue_depth{queue="q"} 10', text)
+        self.assertIn('pycv_decode_ms_bucket{le="2.5"} 0', text)
+        self.assertIn('pycv_decode_ms_bucket{le="5"} 1', text)
+        self.assertIn('pycv_decode_ms_bucket{le="+Inf"} 2', text)
+        self.assertIn('pycv_decode_ms_sum 3003', text)
+
+    def test_escape(self):
+        self._metrics.inc('frames_read', camera='cam "1"\\\nlobby')
+        self.assertIn(
+            'pycv_frames_read_total{camera="cam \\"1\\"\\\\\\nlobby"} 1', self._metrics.render()
+        )
+
+    def test_serve(self):
+        self._metrics.inc('frames_read', camera='cam_1')
+        server = self._metrics.serve(0)
+        try:
+            url = f'http://127.0.0.1:{server.server_port}/metrics'
+            with urllib.request.urlopen(url) as response:
+                self.assertIn(b'pycv_frames_read_total{camera="cam_1"} 1', response.read())
+        finally:
+            self._metrics.stop()
+
+    def test_ml_queue(self):
+        ml_queue = MLQueue('q', {'max_size': 50, 'max_batch_size': 20, 'metrics': self._metrics})
+        for index in range(35):
+            ml_queue.put({'test': 'test'})
+        ml_queue.get()
+
+        self.assertEqual(self._metrics.get('queue_items_put', queue='q'), 35)
+        self.assertEqual(self._metrics.get('queue_dilution_drops', queue='q'), 13)
+        self.assertEqual(self._metrics.get('queue_depth', queue='q'), 21)
+        self.assertEqual(self._metrics.get('queue_batch_size', queue='q'), 17)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+
+if __name__ == '__main__':
+    unittest.main()
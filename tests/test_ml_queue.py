@@ -1,10 +1,15 @@
+import asyncio
 import os
 import unittest
 import queue
 import logging
+import shutil
 import sys
+import tempfile
 
-from ml_queue import MLQueue
+from ml_queue import MLQueue, AsyncMLQueue, LatencyBalancer
+from metrics import Metrics
+from spill_log import SpillLog
 
 
 class TestMLQueue(unittest.TestCase):
@@ -223,6 +228,313 @@ class TestMLQueue(unittest.TestCase):
             []
         )
 
+    def test_bulk_operations(self):
+        bulk_queue = self._small_ml_queue._queue
+        self.assertEqual(bulk_queue.put_many(list(range(10))), 10)
+        self.assertEqual(bulk_queue.get_many(3), [9, 8, 7])
+        self.assertEqual(bulk_queue.get_many(1, skip=2), [4])
+        self.assertEqual(bulk_queue.get_many(10, block=False), [3, 2, 1, 0])
+        self.assertEqual(bulk_queue.get_many(1, block=False), [])
+
+        self.assertEqual(bulk_queue.put_many(list(range(60))), 50)
+        self.assertEqual(bulk_queue.get_many(1), [59])
+        self.assertEqual(bulk_queue.get_many(1, block=False, skip=100), [10])
+        self.assertEqual(len(self._small_ml_queue), 0)
+
+    def test_put_skipped(self):
+        metrics = Metrics()
+        ml_queue = MLQueue('queue_id', {'max_size': 50, 'max_batch_size': 20, 'metrics': metrics})
+        ml_queue.put(list(range(60)))
+
+        self.assertEqual(metrics.get('queue_items_put', queue='queue_id'), 50)
+        self.assertEqual(metrics.get('queue_put_skipped', queue='queue_id'), 10)
+
+    def test_multi_source(self):
+        ml_queue = MLQueue(
+            'multi_queue_id', {'max_size': 100, 'max_batch_size': 20, 'multi_source': True}
+        )
+        busy = ml_queue.get_source('busy', priority=3)
+        busy.put([('busy', index) for index in range(40)])
+        ml_queue.put([('quiet', index) for index in range(4)], source='quiet')
+
+        self.assertEqual(len(ml_queue), 44)
+        self.assertEqual(ml_queue.get_source_sizes(), {'busy': 40, 'quiet': 4})
+        batch = ml_queue.get_batch(8)
+        self.assertEqual([item[0] for item in batch].count('quiet'), 2)
+        self.assertEqual(batch[:4], [('busy', 39), ('busy', 38), ('busy', 37), ('quiet', 3)])
+
+        # The oldest items of overloaded source are dropped
+        dropped = []
+        self.assertEqual(ml_queue._queue.get_many(1, skip=10, dropped=dropped), [('busy', 33)])
+        self.assertEqual(dropped, [('busy', index) for index in range(10)])
+        self.assertEqual(ml_queue.get_source_sizes(), {'busy': 23, 'quiet': 2})
+
+        self.assertEqual(len(ml_queue.get_batch(100)), 25)
+        self.assertEqual(ml_queue.get_source_sizes(), {})
+        with self.assertRaises(ValueError):
+            self._small_ml_queue.get_source('busy')
+        with self.assertRaises(ValueError):
+            ml_queue.get_source('busy', priority=0)
+
+    def test_custom_balancer(self):
+        class FixedBalancer:
+            def __init__(self):
+                self.updates = []
+                self.got = 0
+
+            def update(self, items, load, now):
+                self.updates.append((items, load, now))
+
+            def observe_get(self, count, now):
+                self.got += count
+
+            def get_batch_size(self):
+                return 4
+
+            def get_dilution(self):
+                return 1
+
+        balancer = FixedBalancer()
+        ml_queue = MLQueue(
+            'custom_queue_id',
+            {'max_size': 50, 'max_batch_size': 20, 'balancer': balancer, 'clock': lambda: 7}
+        )
+        ml_queue.put(list(range(10)))
+
+        self.assertEqual(ml_queue.get(), [9, 8, 7, 6])
+        self.assertEqual(balancer.got, 4)
+        self.assertEqual(balancer.updates, [(10, 0.2, 7), (6, 0.12, 7)])
+
+    def test_latency_balancer(self):
+        balancer = LatencyBalancer(32, target_latency=0.5, interval=0.25)
+        balancer.update(100, 0.1, 0)
+        now = 0
+        # Consumer gets 25 items per 0.25 s, 100 items are 1 s latency
+        while balancer.get_batch_size() < 32:
+            now += 0.25
+            balancer.observe_get(25, now)
+            balancer.update(100, 0.1, now)
+            self.assertEqual(balancer.get_dilution(), 1 if balancer.get_batch_size() < 32 else 51)
+        self.assertAlmostEqual(balancer.get_latency(100), 1)
+        self.assertEqual(now, 2)
+
+        # Items over target latency are dropped at once
+        balancer.update(60, 0.06, now)
+        self.assertEqual(balancer.get_dilution(), 11)
+        balancer.update(10, 0.01, now)
+        self.assertEqual(balancer.get_dilution(), 1)
+
+        now += 0.25
+        balancer.observe_get(25, now)
+        balancer.update(10, 0.01, now)
+        self.assertEqual(balancer.get_batch_size(), 16)
+
+    def test_drop_oldest_overflow(self):
+        metrics = Metrics()
+        ml_queue = MLQueue(
+            'overflow_queue_id',
+            {'max_size': 10, 'max_batch_size': 5, 'overflow': 'drop_oldest', 'metrics': metrics}
+        )
+        ml_queue.put(list(range(8)))
+        ml_queue.put(list(range(8, 13)))
+        ml_queue.put(list(range(13, 25)))
+
+        self.assertEqual(len(ml_queue), 10)
+        self.assertEqual(ml_queue._queue.get_many(10, block=False), list(range(24, 14, -1)))
+        self.assertEqual(metrics.get('queue_overflow_drops', queue='overflow_queue_id'), 13)
+        self.assertEqual(metrics.get('queue_put_skipped', queue='overflow_queue_id'), 2)
+        with self.assertRaises(ValueError):
+            MLQueue('queue_id', {'max_size': 10, 'max_batch_size': 5, 'overflow': 'block'})
+
+    def test_max_bytes(self):
+        metrics = Metrics()
+        ml_queue = MLQueue(
+            'bytes_queue_id', {'max_bytes': 1000, 'max_batch_size': 5, 'metrics': metrics}
+        )
+        ml_queue.put([bytes(100)] * 4)
+
+        self.assertEqual(ml_queue.get_nbytes(), 400)
+        self.assertAlmostEqual(ml_queue.get_load(), 0.4)
+        self.assertEqual(ml_queue._items_in_percent, 0.1)
+        self.assertEqual(metrics.get('queue_bytes', queue='bytes_queue_id'), 400)
+
+        # Latest items which fit the budget are put
+        ml_queue.put([bytes(200), bytes(300), bytes(250)])
+        self.assertEqual(len(ml_queue), 6)
+        self.assertEqual(ml_queue.get_nbytes(), 950)
+        self.assertEqual(metrics.get('queue_put_skipped', queue='bytes_queue_id'), 1)
+
+        self.assertEqual([len(item) for item in ml_queue._queue.get_many(2, False)], [250, 300])
+        self.assertEqual(ml_queue.get_nbytes(), 400)
+
+    def test_max_bytes_sizer(self):
+        ml_queue = MLQueue(
+            'sizer_queue_id',
+            {'max_size': 20, 'max_bytes': 50, 'max_batch_size': 5, 'sizer': lambda item: item}
+        )
+        ml_queue.put([10, 20])
+        self.assertAlmostEqual(ml_queue.get_load(), 0.6)
+        ml_queue.get_batch(2)
+        ml_queue.put([1] * 10)
+        # Items limit is the tighter one
+        self.assertAlmostEqual(ml_queue.get_load(), 0.5)
+
+    def test_max_bytes_drop_oldest(self):
+        metrics = Metrics()
+        ml_queue = MLQueue(
+            'bytes_overflow_queue_id',
+            {
+                'max_bytes': 100, 'max_batch_size': 5, 'overflow': 'drop_oldest',
+                'sizer': lambda item: item[1], 'metrics': metrics
+            }
+        )
+        ml_queue.put([('a', 30), ('b', 30), ('c', 30)])
+        ml_queue.put(('d', 50))
+
+        self.assertEqual(ml_queue._queue.get_many(3, block=False), [('d', 50), ('c', 30)])
+        self.assertEqual(ml_queue.get_nbytes(), 0)
+        self.assertEqual(
+            metrics.get('queue_overflow_drops', queue='bytes_overflow_queue_id'), 2
+        )
+
+    def test_max_bytes_multi_source(self):
+        ml_queue = MLQueue(
+            'bytes_multi_queue_id',
+            {
+                'max_bytes': 100, 'max_batch_size': 5, 'multi_source': True,
+                'overflow': 'drop_oldest', 'sizer': len
+            }
+        )
+        ml_queue.put([b'x' * 10] * 6, source='busy')
+        ml_queue.put([b'y' * 10] * 2, source='quiet')
+        ml_queue.put([b'x' * 20] * 2, source='busy')
+
+        self.assertEqual(ml_queue.get_nbytes(), 100)
+        self.assertEqual(ml_queue.get_source_sizes(), {'busy': 6, 'quiet': 2})
+        ml_queue._queue.get_many(8, block=False)
+        self.assertEqual(ml_queue.get_nbytes(), 0)
+
+    def test_spill(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        metrics = Metrics()
+        config = {
+            'max_size': 10, 'max_batch_size': 4, 'balancer': LatencyBalancer(4),
+            'spill': SpillLog(directory, segment_size=4096), 'metrics': metrics
+        }
+        ml_queue = MLQueue('spill_queue_id', config)
+        for item in range(12):
+            ml_queue.put({'item': item})
+
+        self.assertEqual((len(ml_queue), ml_queue.get_spilled()), (8, 4))
+        self.assertEqual([item['item'] for item in ml_queue.get_batch(4)], [7, 6, 5, 4])
+        # Load is below low water mark, spilled items are back in order
+        self.assertEqual((len(ml_queue), ml_queue.get_spilled()), (8, 0))
+        self.assertEqual([item['item'] for item in ml_queue.get_batch(4)], [11, 10, 9, 8])
+        self.assertEqual(metrics.get('queue_spilled_items', queue='spill_queue_id'), 4)
+        self.assertEqual(metrics.get('queue_spill_drained', queue='spill_queue_id'), 4)
+
+        # Whole put which doesn't fit is spilled, nothing is skipped or cleared
+        ml_queue.put([{'item': item} for item in range(12, 30)])
+        self.assertEqual((len(ml_queue), ml_queue.get_spilled()), (10, 12))
+        self.assertIsNone(metrics.get('queue_put_skipped', queue='spill_queue_id'))
+
+        # Spilled items are recovered after restart
+        recovered = MLQueue('spill_queue_id', dict(config, spill=SpillLog(directory)))
+        self.assertEqual((len(recovered), recovered.get_spilled()), (8, 4))
+        self.assertEqual(recovered.get_batch(4)[0], {'item': 19})
+
+    def test_spill_multi_source(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        ml_queue = MLQueue(
+            'spill_multi_queue_id',
+            {
+                'max_size': 4, 'max_batch_size': 4, 'multi_source': True,
+                'balancer': LatencyBalancer(4), 'spill': SpillLog(directory, segment_size=4096),
+                'spill_high_water': 0.5, 'spill_low_water': 0.5
+            }
+        )
+        ml_queue.put([1, 2], source='a')
+        ml_queue.put([3, 4], source='b')
+        self.assertEqual(ml_queue.get_source_sizes(), {'a': 2})
+
+        ml_queue.get_batch(2)
+        self.assertEqual(ml_queue.get_source_sizes(), {'b': 2})
+
+    def test_on_drop(self):
+        dropped = []
+        ml_queue = MLQueue(
+            'drop_queue_id', {'max_size': 10, 'max_batch_size': 5, 'on_drop': dropped.extend}
+        )
+        ml_queue.put(list(range(8)))
+        ml_queue.put(list(range(8, 12)))
+        # Skipped put items and then cleared queue
+        self.assertEqual(dropped, [8, 9] + list(range(8)) + [10, 11])
+
+        del dropped[:]
+        ml_queue.put(list(range(5)))
+        ml_queue._get_many(1, False, skip=2)
+        self.assertEqual(dropped, [3, 4])
+
+    def test_async_queue(self):
+        async def consume(async_ml_queue, batches):
+            async for batch in async_ml_queue:
+                batches.append(batch)
+                if len(batches) == 2:
+                    break
+
+        async def run():
+            async_ml_queue = AsyncMLQueue('async_queue_id', {'max_size': 50, 'max_batch_size': 20})
+            batches = []
+            consumer = asyncio.ensure_future(consume(async_ml_queue, batches))
+            await asyncio.sleep(0)
+            self.assertEqual(batches, [])
+
+            await async_ml_queue.put([{'test': 'test'}] * 10)
+            await asyncio.sleep(0)
+            await async_ml_queue.put({'test': 'test'})
+            await asyncio.wait_for(consumer, 1)
+            return batches
+
+        batches = asyncio.run(run())
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(len(batches[0]), 8)
+        self.assertEqual(len(batches[1]), 2)
+
+    def test_get_batch(self):
+        self._big_ml_queue.put([{'test': 'test'}] * 100)
+        self.assertEqual(len(self._big_ml_queue.get_batch()), 100)
+        self.assertEqual(self._big_ml_queue.get_batch(max_latency_ms=10), [])
+
+        self._big_ml_queue.put([{'test': 'test'}] * 300)
+        self.assertEqual(len(self._big_ml_queue.get_batch(max_size=50)), 50)
+        self.assertEqual(len(self._big_ml_queue.get_batch(max_latency_ms=10)), 250)
+
+        async def run():
+            async_ml_queue = AsyncMLQueue('async_queue_id', {'max_size': 50, 'max_batch_size': 20})
+            consumer = asyncio.ensure_future(
+                async_ml_queue.get_batch(max_size=5, max_latency_ms=1000)
+            )
+            for index in range(5):
+                await async_ml_queue.put({'test': 'test'})
+                await asyncio.sleep(0)
+            full_batch = await asyncio.wait_for(consumer, 1)
+
+            await async_ml_queue.put({'test': 'test'})
+            partial_batch = await async_ml_queue.get_batch(max_size=5, max_latency_ms=10)
+
+            # Defaults are the same as sync ones: items in the queue without waiting
+            for index in range(12):
+                await async_ml_queue.put({'test': 'test'})
+            default_batches = [await async_ml_queue.get_batch(), await async_ml_queue.get_batch()]
+            return full_batch, partial_batch, default_batches
+
+        full_batch, partial_batch, default_batches = asyncio.run(run())
+        self.assertEqual(len(full_batch), 5)
+        self.assertEqual(len(partial_batch), 1)
+        self.assertEqual([len(batch) for batch in default_batches], [12, 0])
+
     def tearDown(self):
         logging.disable(logging.NOTSET)
 
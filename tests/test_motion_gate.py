@@ -0,0 +1,52 @@
+import unittest
+
+import numpy as np
+
+from frame import Frame
+from motion_gate import MotionGate
+
+
+def make_frame(timestamp, box=None):
+    image = np.full((360, 640, 3), 100, dtype=np.uint8)
+    if box:
+        x, y = box
+        image[y:y + 60, x:x + 80] = 250
+    return Frame(image, BGR=True, timestamp=timestamp)
+
+
+class TestMotionGate(unittest.TestCase):
+    def setUp(self):
+        self._gate = MotionGate(threshold=0.01, keyframe_interval=10)
+
+    def test_static_scene(self):
+        self.assertTrue(self._gate.check(make_frame(0)))
+        self.assertIsNone(self._gate.get_last_score())
+        self.assertFalse(self._gate.check(make_frame(1)))
+        self.assertEqual(self._gate.get_last_score(), 0)
+
+        # Keyframe
+        self.assertTrue(self._gate.check(make_frame(10)))
+        self.assertFalse(self._gate.check(make_frame(11)))
+
+    def test_motion(self):
+        self.assertTrue(self._gate.check(make_frame(0, (0, 0))))
+        self.assertFalse(self._gate.check(make_frame(1, (0, 0))))
+        self.assertTrue(self._gate.check(make_frame(2, (300, 200))))
+        self.assertGreater(self._gate.get_last_score(), 0.01)
+
+    def test_noise(self):
+        self._gate.check(make_frame(0))
+        noisy = np.full((360, 640, 3), 100, dtype=np.uint8)
+        noisy += np.random.RandomState(0).randint(0, 10, noisy.shape, dtype=np.uint8)
+
+        self.assertFalse(self._gate.check(Frame(noisy, timestamp=1)))
+
+    def test_corrupted(self):
+        self.assertFalse(self._gate.check(Frame(b'not an image')))
+        self._gate.check(make_frame(0))
+        self._gate.reset()
+        self.assertTrue(self._gate.check(make_frame(1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
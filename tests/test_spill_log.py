@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+
+from spill_log import SpillLog, SEGMENT_SUFFIX
+
+
+class TestSpillLog(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def _get_segments(self):
+        return sorted(name for name in os.listdir(self._directory) if name.endswith(SEGMENT_SUFFIX))
+
+    def test_fifo(self):
+        log = SpillLog(self._directory, segment_size=100)
+        records = [bytes([index]) * 30 for index in range(10)]
+
+        self.assertEqual(log.append_many(records[:7]), 7)
+        self.assertTrue(log.append(records[7] * 5))
+        self.assertEqual(len(log), 8)
+        # Two records per segment, the big one has its own segment
+        self.assertEqual(len(self._get_segments()), 5)
+        self.assertEqual(log.read_many(3), records[:3])
+        # Fully read segments are deleted
+        self.assertEqual(len(self._get_segments()), 4)
+        self.assertEqual(log.read_many(3), records[3:6])
+        self.assertEqual(len(self._get_segments()), 3)
+        log.append_many(records[8:])
+
+        self.assertEqual(log.read_many(10), records[6:7] + [records[7] * 5] + records[8:])
+        self.assertIsNone(log.read())
+        self.assertEqual((len(log), self._get_segments(), log.get_nbytes()), (0, [], 0))
+        log.close()
+
+    def test_max_bytes(self):
+        log = SpillLog(self._directory, segment_size=100, max_bytes=200)
+
+        self.assertEqual(log.append_many([b'x' * 60] * 5), 2)
+        self.assertFalse(log.append(b'x' * 60))
+        self.assertEqual(log.get_nbytes(), 200)
+        log.read()
+        log.read()
+        self.assertTrue(log.append(b'x' * 60))
+        log.close()
+
+    def test_recovery(self):
+        log = SpillLog(self._directory, segment_size=100)
+        log.append_many([bytes([index]) * 20 for index in range(8)])
+        log.read_many(5)
+        log.flush()
+        # Process crash: the log isn't closed
+        recovered = SpillLog(self._directory, segment_size=100)
+
+        self.assertEqual(len(recovered), 3)
+        self.assertEqual(recovered.read_many(5), [bytes([index]) * 20 for index in range(5, 8)])
+        recovered.close()
+        log.close()
+
+    def test_torn_record(self):
+        log = SpillLog(self._directory, segment_size=1000)
+        log.append_many([b'a' * 10, b'b' * 10, b'c' * 10])
+        log.close()
+        path = os.path.join(self._directory, self._get_segments()[0])
+        with open(path, 'r+b') as file:
+            # Payload of the last record is partially written
+            file.seek(2 * (12 + 10) + 12 + 5)
+            file.write(b'\x00' * 5)
+
+        recovered = SpillLog(self._directory, segment_size=1000)
+        self.assertEqual(len(recovered), 2)
+        recovered.append(b'd' * 10)
+        self.assertEqual(recovered.read_many(5), [b'a' * 10, b'b' * 10, b'd' * 10])
+        recovered.close()